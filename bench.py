@@ -0,0 +1,485 @@
+'''Benchmarks for the file system operations and the chain toolkit
+
+The file system benchmarks drive Operations (and through it
+SQLfs_Manager) directly, no mount is needed. The chain benchmarks run the
+commit_transaction flows against a fake JSON-RPC node on localhost, they
+are skipped if commit_transaction cannot be imported (it needs pycoin and
+a config module).
+
+Results are printed as JSON, or written to --output. Pass a previous
+result file to --compare to also print how each benchmark changed.
+'''
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+import platform
+import threading
+from argparse import ArgumentParser
+from binascii import hexlify, unhexlify
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    ThreadingHTTPServer = None
+
+import llfuse
+
+from hello_fuse import Operations
+
+KiB = 1024
+MiB = 1024 * KiB
+
+# Size of each read or write request, the largest the kernel sends
+IO_SIZE = 128 * KiB
+RANDOM_IO_SIZE = 4 * KiB
+
+FILE_SIZES = (64 * KiB, MiB, 16 * MiB)
+
+
+class RequestContext(object):
+    '''Stands in for the request context of the kernel'''
+
+    uid = os.getuid()
+    gid = os.getgid()
+
+
+class Bench(object):
+    '''Runs benchmarks and collects their results
+
+    Every benchmark reports the operations and bytes it processed, the
+    rates follow from the time it took.
+    '''
+
+    def __init__(self, db_dir=None, db_options={}, scale=1, only=None):
+        self.db_dir = db_dir
+        self.db_options = db_options
+        self.scale = scale
+        self.only = only
+        self.results = {}
+        self.dbs = 0
+
+    def count(self, n):
+        return max(1, int(n * self.scale))
+
+    def operations(self, operations_class=Operations):
+        '''Return a new, empty file system'''
+
+        if self.db_dir is None:
+            return operations_class(**self.db_options)
+        self.dbs += 1
+        path = os.path.join(self.db_dir, 'bench%d.db' % self.dbs)
+        return operations_class(path, **self.db_options)
+
+    def run(self, name, fn, *args):
+        '''Time fn(*args), which returns (ops, bytes)
+
+        Returns False if the benchmark was filtered out.
+        '''
+
+        if self.only is not None and self.only not in name:
+            return False
+        start = time.perf_counter()
+        ops, nbytes = fn(*args)
+        seconds = time.perf_counter() - start
+        result = {'ops': ops, 'seconds': seconds,
+                  'ops_per_sec': ops / seconds if seconds else None}
+        if nbytes:
+            result['bytes'] = nbytes
+            result['mib_per_sec'] = nbytes / MiB / seconds if seconds else None
+        self.results[name] = result
+        print('%-36s %10.4fs %12.1f ops/s' % (name, seconds, result['ops_per_sec'] or 0),
+              file=sys.stderr)
+        return True
+
+
+#
+# File system benchmarks
+#
+
+def bench_seq_write(ops, data):
+    fh, _ = ops.create(llfuse.ROOT_INODE, b'seq', 0o100644, os.O_RDWR, RequestContext())
+    n = 0
+    for off in range(0, len(data), IO_SIZE):
+        ops.write(fh, off, data[off:off + IO_SIZE])
+        n += 1
+    ops.release(fh)
+    return n, len(data)
+
+
+def bench_seq_read(ops, inode, size):
+    fh = ops.open(inode, os.O_RDONLY)
+    n = nbytes = 0
+    for off in range(0, size, IO_SIZE):
+        nbytes += len(ops.read(fh, off, IO_SIZE))
+        n += 1
+    ops.release(fh)
+    return n, nbytes
+
+
+def bench_random_write(ops, inode, size, n):
+    rnd = random.Random(n)
+    buf = os.urandom(RANDOM_IO_SIZE)
+    fh = ops.open(inode, os.O_RDWR)
+    for _ in range(n):
+        ops.write(fh, rnd.randrange(0, max(size - RANDOM_IO_SIZE, 1)), buf)
+        # Each write goes to the database instead of merging in the write buffer
+        ops.flush(fh)
+    ops.release(fh)
+    return n, n * RANDOM_IO_SIZE
+
+
+def bench_random_read(ops, inode, size, n):
+    rnd = random.Random(n)
+    fh = ops.open(inode, os.O_RDONLY)
+    nbytes = 0
+    for _ in range(n):
+        nbytes += len(ops.read(fh, rnd.randrange(0, max(size - RANDOM_IO_SIZE, 1)),
+                               RANDOM_IO_SIZE))
+    ops.release(fh)
+    return n, nbytes
+
+
+def bench_create_unlink(ops, n):
+    ctx = RequestContext()
+    for i in range(n):
+        fh, _ = ops.create(llfuse.ROOT_INODE, b'f%d' % i, 0o100644, os.O_RDWR, ctx)
+        ops.release(fh)
+    for i in range(n):
+        ops.unlink(llfuse.ROOT_INODE, b'f%d' % i)
+    return 2 * n, 0
+
+
+def make_tree(ops, depth):
+    inode = llfuse.ROOT_INODE
+    for i in range(depth):
+        inode = ops.mkdir(inode, b'd%d' % i, 0o40755, RequestContext()).st_ino
+
+
+def bench_lookup_chain(ops, depth, n):
+    for _ in range(n):
+        inode = llfuse.ROOT_INODE
+        for i in range(depth):
+            inode = ops.lookup(inode, b'd%d' % i).st_ino
+    return n * depth, 0
+
+
+def make_dir(ops, n):
+    ctx = RequestContext()
+    inode = ops.mkdir(llfuse.ROOT_INODE, b'big', 0o40755, ctx).st_ino
+    for i in range(n):
+        fh, _ = ops.create(inode, b'f%d' % i, 0o100644, os.O_RDWR, ctx)
+        ops.release(fh)
+    return inode
+
+
+def bench_readdir(ops, inode, n):
+    fh = ops.opendir(inode)
+    entries = sum(1 for _ in ops.readdir(fh, 0))
+    ops.releasedir(fh)
+    assert entries >= n
+    return entries, 0
+
+
+def bench_statfs(ops, n):
+    for _ in range(n):
+        ops.statfs()
+    return n, 0
+
+
+def run_fs(bench, sizes):
+    for size in sizes:
+        label = '%dk' % (size // KiB)
+        ops = bench.operations()
+        # Random, so that no two blocks are stored as one
+        data = os.urandom(size)
+        if not bench.run('seq_write_' + label, bench_seq_write, ops, data):
+            # The other benchmarks of this size work on the same file
+            bench_seq_write(ops, data)
+        inode = ops.lookup(llfuse.ROOT_INODE, b'seq').st_ino
+        bench.run('seq_read_' + label, bench_seq_read, ops, inode, size)
+        n = bench.count(1000)
+        bench.run('random_write_4k_' + label, bench_random_write, ops, inode, size, n)
+        bench.run('random_read_4k_' + label, bench_random_read, ops, inode, size, n)
+        ops.destroy()
+
+    ops = bench.operations()
+    bench.run('create_unlink', bench_create_unlink, ops, bench.count(5000))
+    ops.destroy()
+
+    ops = bench.operations()
+    depth = 32
+    make_tree(ops, depth)
+    bench.run('lookup_depth_%d' % depth, bench_lookup_chain, ops, depth, bench.count(1000))
+    ops.destroy()
+
+    ops = bench.operations()
+    n = bench.count(10000)
+    inode = make_dir(ops, n)
+    bench.run('readdir_%d' % n, bench_readdir, ops, inode, n)
+    bench.run('statfs', bench_statfs, ops, bench.count(10000))
+    ops.destroy()
+
+
+#
+# Chain benchmarks
+#
+
+def hash_txid(raw):
+    return hexlify(hashlib.sha256(hashlib.sha256(raw).digest()).digest()[::-1]).decode('ascii')
+
+
+class FakeNode(object):
+    '''Just enough of the node's JSON-RPC interface for commit_transaction
+
+    The wallet holds *n_utxos* coins of *script* and a chain of *depth*
+    transactions, each spending the one before and carrying an OP_RETURN
+    payload. The newest one is unspent.
+    '''
+
+    def __init__(self, address, wif, script, depth, n_utxos, fee_per_kb):
+        self.address = address
+        self.wif = wif
+        self.fee_per_kb = fee_per_kb
+        self.txs = {}
+        self.sent = 0
+
+        prev = None
+        for i in range(depth):
+            payload = hexlify(b'bench message %d' % i).decode('ascii')
+            txid = hash_txid(b'chain%d' % i)
+            self.txs[txid] = {
+                'txid': txid, 'confirmations': depth - i,
+                'vin': [{'txid': prev, 'vout': 0}] if prev else [{'coinbase': '00'}],
+                'vout': [{'value': 1.0, 'n': 0,
+                          'scriptPubKey': {'hex': script, 'address': address}},
+                         {'value': 0.01, 'n': 1,
+                          'scriptPubKey': {'hex': '6a%02x%s' % (len(payload) // 2, payload)}}]}
+            prev = txid
+        self.head = prev
+        self.utxos = [{'txid': prev, 'vout': 0, 'amount': 1.0, 'scriptPubKey': script,
+                       'address': address}]
+        for i in range(n_utxos):
+            self.utxos.append({'txid': hash_txid(b'coin%d' % i), 'vout': 0,
+                               'amount': random.Random(i).randint(1, 10**4) / 10**4,
+                               'scriptPubKey': script, 'address': address})
+
+    def call(self, method, params):
+        if method == 'getrawtransaction':
+            return self.txs.get(params[0])
+        if method == 'listunspent':
+            return self.utxos
+        if method == 'estimatesmartfee':
+            return {'feerate': self.fee_per_kb / 10**6}
+        if method == 'dumpprivkey':
+            return self.wif if params[0] == self.address else None
+        if method == 'sendrawtransaction':
+            self.sent += 1
+            return hash_txid(unhexlify(params[0]))
+        return None
+
+    def handler(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes, do not let them
+            # wait for delayed ACKs
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                rq = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if isinstance(rq, list):
+                    reply = [{'id': r['id'], 'result': node.call(r['method'], r['params']),
+                              'error': None} for r in rq]
+                else:
+                    reply = {'id': rq['id'], 'result': node.call(rq['method'], rq['params']),
+                             'error': None}
+                body = json.dumps(reply).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def serve(self):
+        '''Start serving on a free port, return the server'''
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name='fake-node')
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+def run_chain(bench):
+    try:
+        import commit_transaction as ct
+        from pycoin.key import Key
+        from pycoin.encoding import a2b_hashed_base58
+        from pycoin.tx.script import tools
+    except ImportError as exc:
+        print('Skipping chain benchmarks: %s' % exc, file=sys.stderr)
+        return
+    if ThreadingHTTPServer is None:
+        print('Skipping chain benchmarks: needs Python 3.7', file=sys.stderr)
+        return
+
+    from rpcclient import RPCClient
+    from txcache import TxCache
+    from pycoin_ext import SecretExponentDB
+    from coinselect import select_coins
+
+    key = Key(secret_exponent=0xbe4c4)
+    wif = key.wif()
+    address = key.address()
+    script = hexlify(tools.compile('OP_DUP OP_HASH160 %s OP_EQUALVERIFY OP_CHECKSIG'
+                                   % hexlify(key.hash160()).decode('ascii'))).decode('ascii')
+    depth = bench.count(200)
+    node = FakeNode(address, wif, script, depth, bench.count(2000), 10**5)
+    server = node.serve()
+
+    # Point the module at the fake node. The key store is filled up front
+    # so that a keystore in the user's config is neither read nor written.
+    ct.rpc_client = RPCClient('http://127.0.0.1:%d/' % server.server_address[1])
+    ct.key_db = SecretExponentDB()
+    ct.key_db.add_wifs([(address, wif)], [a2b_hashed_base58(wif)[:1]])
+    head = ct.create_spend(node.utxos[0])
+    pool = [ct.create_spend(utxo) for utxo in node.utxos]
+
+    def get_txs_cold():
+        ct.tx_cache = TxCache(':memory:')
+        return len(ct.get_txs(list(node.txs))), 0
+
+    def get_txs_warm():
+        return len(ct.get_txs(list(node.txs))), 0
+
+    def walk_chain():
+        ct.tx_cache = TxCache(':memory:')
+        return sum(1 for _ in ct.walk_chain([head])), 0
+
+    def search_last():
+        ct.search_last_tx_data([head])
+        return 1, 0
+
+    def listunspent():
+        n = 0
+        for _ in range(bench.count(20)):
+            n += len(ct.get_utxos()[0])
+        return n, 0
+
+    def coin_selection():
+        n = bench.count(100)
+        for i in range(n):
+            select_coins([head], pool, 10**5, 1, 80, 10**4 * (i + 1))
+        return n, 0
+
+    def put_data(size):
+        data = os.urandom(size)
+        txids = ct.put_data(head, [address], data, pool)
+        return len(txids), size
+
+    bench.run('chain_get_txs_cold_%d' % depth, get_txs_cold)
+    bench.run('chain_get_txs_warm_%d' % depth, get_txs_warm)
+    bench.run('chain_walk_%d' % depth, walk_chain)
+    bench.run('chain_search_last', search_last)
+    bench.run('chain_listunspent_%d' % len(node.utxos), listunspent)
+    bench.run('chain_coin_selection_%d' % len(pool), coin_selection)
+    for size in (80, 2 * KiB):
+        bench.run('chain_put_data_%d' % size, put_data, size)
+
+    server.shutdown()
+    server.server_close()
+
+
+def compare(results, baseline):
+    '''Print the change in time of every benchmark in both runs'''
+
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['seconds'], results[name]['seconds']
+        print('%-36s %10.4fs -> %10.4fs  %+7.1f%%'
+              % (name, old, new, (new - old) / old * 100 if old else 0), file=sys.stderr)
+
+
+def parse_args():
+    '''Parse command line'''
+
+    parser = ArgumentParser(description='Benchmark the file system and chain operations')
+
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write the results to this file instead of stdout')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Results of an earlier run to compare with')
+    parser.add_argument('--on-disk', action='store_true', default=False,
+                        help='Keep the file systems in database files in a '
+                        'temporary directory instead of in memory')
+    parser.add_argument('--commit-ops', type=int, default=1,
+                        help='Commit after this many operations (default: %(default)s)')
+    parser.add_argument('--sizes', type=str, default=None,
+                        help='Comma separated file sizes in KiB (default: %s)'
+                        % ','.join(str(s // KiB) for s in FILE_SIZES))
+    parser.add_argument('--scale', type=float, default=1,
+                        help='Multiply the operation counts by this (default: %(default)s)')
+    parser.add_argument('--only', type=str, default=None,
+                        help='Only run benchmarks whose name contains this')
+    parser.add_argument('--no-chain', action='store_true', default=False,
+                        help='Skip the chain benchmarks')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    options = parse_args()
+    sizes = FILE_SIZES
+    if options.sizes is not None:
+        sizes = [int(s) * KiB for s in options.sizes.split(',')]
+
+    db_dir = tempfile.mkdtemp(prefix='coinfs-bench') if options.on_disk else None
+    bench = Bench(db_dir, {'commit_ops': options.commit_ops}, options.scale, options.only)
+    try:
+        # The operations expect to be called with the global lock held,
+        # as they are from llfuse.main()
+        with llfuse.lock:
+            run_fs(bench, sizes)
+        if not options.no_chain:
+            run_chain(bench)
+    finally:
+        if db_dir is not None:
+            shutil.rmtree(db_dir)
+
+    report = {'meta': {'time': time.time(),
+                       'python': platform.python_version(),
+                       'sqlite': sqlite3.sqlite_version,
+                       'platform': platform.platform(),
+                       'on_disk': options.on_disk,
+                       'commit_ops': options.commit_ops,
+                       'scale': options.scale},
+              'results': bench.results}
+
+    if options.compare is not None:
+        with open(options.compare) as fh:
+            compare(bench.results, json.load(fh)['results'])
+
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(options.output, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
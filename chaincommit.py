@@ -0,0 +1,367 @@
+'''Background committer storing written files on chain
+
+Files that were written are put in a journal table of the file system
+database when they are closed or fsync'ed, and a worker thread stores
+their contents on chain with commit_transaction. The file system only
+waits for the journal entry, never for the node, unless the queue is
+full.
+
+A journal entry goes through these states:
+
+* pending: waiting for the worker. Only the newest contents of a file
+  are stored, so a file is only pending once.
+* signed: its transactions are built and signed, the raw transactions
+  are journaled before they are sent.
+* sent: the node accepted the transactions.
+* confirmed: the last transaction has CONFIRMATIONS confirmations.
+* failed: the file cannot be stored (deleted, empty, not enough coins).
+
+Files of more than MAX_CHAIN_TXS chunks do not fit in the mempool at
+once, they are stored a part at a time. The contents are kept in the
+journal and the entry is pending again once a part is confirmed, until
+all chunks are. When the node accepts only the start of a part, the
+rest is sent as the next part.
+
+After a crash, signed entries are sent again (the node ignores
+transactions it already has) and pending ones are picked up. Sent
+transactions that the node forgot, for example when they were dropped
+from the mempool, make their entry pending again.
+'''
+
+import json
+import queue
+import logging
+import threading
+from time import time, sleep
+
+import llfuse
+
+from sqlmanager import NoSuchRowError
+from coinselect import InsufficientFunds
+import commit_transaction
+
+log = logging.getLogger()
+
+# Journal ids waiting for the worker, writers block when there are more
+QUEUE_SIZE = 64
+# The node rejects chains of more unconfirmed transactions than its
+# mempool ancestor limit
+MAX_CHAIN_TXS = 25
+# Seconds between checks for confirmations, and before retrying after an
+# error
+POLL_INTERVAL = 30
+CONFIRMATIONS = 1
+
+
+class ChainCommitter(object):
+    '''Stores files of the file system behind *cm* on chain
+
+    Call enqueue() with the global lock held, the worker takes it for
+    every database access.
+    '''
+
+    def __init__(self, cm, queue_size=QUEUE_SIZE, poll_interval=POLL_INTERVAL,
+                 confirmations=CONFIRMATIONS):
+        self.cm = cm
+        self.queue = queue.Queue(queue_size)
+        self.poll_interval = poll_interval
+        self.confirmations = confirmations
+        self.stopping = False
+        # Change output of the last transaction sent, the next one spends it
+        self.head = None
+        self.addrs = None
+        # Pending entries the worker holds back until there is room in the
+        # unconfirmed chain
+        self.deferred = []
+        self.thread = None
+
+        self.cm.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chain_journal (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            inode     INT NOT NULL,
+            state     TEXT NOT NULL,
+            queued_at REAL NOT NULL,
+            txids     TEXT,
+            raw       TEXT,
+            sent_at   REAL,
+            confirmed_at REAL,
+            error     TEXT,
+            -- Contents until they are confirmed, and how many of their
+            -- chunks are confirmed so far
+            data      BLOB,
+            stored    INT NOT NULL DEFAULT 0
+        )""")
+        self.cm.cursor.execute("CREATE INDEX IF NOT EXISTS chain_journal_state "
+                               "ON chain_journal (state, inode)")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='chain-committer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stop the worker before the database closes
+
+        Unfinished entries stay in the journal for the next start.
+        '''
+
+        self.stopping = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def enqueue(self, inode):
+        '''Schedule storing the contents of *inode* on chain
+
+        Blocks while the queue is full.
+        '''
+
+        with self.cm.transaction():
+            # An entry stored in parts keeps its contents, newer ones need
+            # an entry of their own
+            if self.cm.cursor.execute("SELECT 1 FROM chain_journal WHERE state='pending' "
+                                      "AND stored=0 AND inode=?",
+                                      (inode,)).fetchone() is not None:
+                return
+            self.cm.cursor.execute("INSERT INTO chain_journal (inode, state, queued_at) "
+                                   "VALUES (?, 'pending', ?)", (inode, time()))
+            entry = self.cm.cursor.lastrowid
+        # Journaled before it is queued, so it survives a crash
+        self.cm.commit()
+
+        with llfuse.lock_released:
+            self.queue.put(entry)
+
+    #
+    # Worker
+    #
+
+    def _journal(self, sql, params=()):
+        '''Run a statement on the journal, return its rows
+
+        None if the committer is stopping and the database may be closed.
+        '''
+
+        with llfuse.lock:
+            if self.stopping:
+                return None
+            # A batch still open on the connection of another thread holds
+            # the write lock, which is not released while we hold this lock
+            self.cm.commit()
+            with self.cm.transaction():
+                rows = self.cm.cursor.execute(sql, params).fetchall()
+            self.cm.commit()
+            return rows
+
+    def run(self):
+        recovered = False
+        while not self.stopping:
+            try:
+                if not recovered:
+                    entries = self.recover()
+                    recovered = True
+                else:
+                    entries = self._next_entries()
+                if self.stopping:
+                    break
+                entries += self.track_confirmations()
+                if entries:
+                    self.send(entries)
+            except Exception:
+                log.exception('Storing files on chain failed, retrying in %d s',
+                              self.poll_interval)
+                # Start over from what the journal says
+                self.head = None
+                self.deferred = []
+                recovered = False
+                sleep(self.poll_interval)
+
+    def _next_entries(self):
+        '''Wait up to poll_interval for queued entries, return them and the
+        deferred ones
+        '''
+
+        entries, self.deferred = self.deferred, []
+        try:
+            entries.append(self.queue.get(timeout=self.poll_interval))
+        except queue.Empty:
+            return entries
+        # Whatever else is queued goes out in the same batch
+        while True:
+            try:
+                entries.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return [entry for entry in entries if entry is not None]
+
+    def recover(self):
+        '''Resume what the journal holds from before the last stop, return
+        the pending entries
+        '''
+
+        rows = self._journal("SELECT id, raw FROM chain_journal WHERE state='signed'") or []
+        for entry, raw in rows:
+            commit_transaction.get_rpc().map('sendrawtransaction',
+                                             [[tx, 1] for tx in json.loads(raw)],
+                                             concurrent=False)
+            self._journal("UPDATE chain_journal SET state='sent', sent_at=? WHERE id=?",
+                          (time(), entry))
+        return [entry for entry, in self._journal("SELECT id FROM chain_journal "
+                                                  "WHERE state='pending'") or []]
+
+    def _unconfirmed(self):
+        rows = self._journal("SELECT txids FROM chain_journal WHERE state='sent'") or []
+        return sum(len(json.loads(txids)) for txids, in rows)
+
+    def _read_file(self, entry):
+        '''Return (contents, chunks stored) of a pending entry, None if it
+        is not pending any more or has no contents
+        '''
+
+        with llfuse.lock:
+            if self.stopping:
+                return None
+            # Batches of other connections are not visible to this one
+            self.cm.commit()
+            row = self.cm.cursor.execute("SELECT inode, data, stored FROM chain_journal "
+                                         "WHERE id=? AND state='pending'", (entry,)).fetchone()
+            if row is None:
+                return None
+            inode, data, stored = row
+            if data is not None:
+                # The rest of a file stored in parts
+                return bytes(data), stored
+            try:
+                size = self.cm.get_row('SELECT size FROM inodes WHERE id=?', (inode,))[0]
+            except NoSuchRowError:
+                size = 0
+            data = self.cm._read(inode, 0, size) if size else b''
+
+        if not data:
+            self._journal("UPDATE chain_journal SET state='failed', error=? WHERE id=?",
+                          ('file is empty or deleted', entry))
+            return None
+        return data, 0
+
+    def send(self, entries):
+        '''Build, journal and send the transactions of *entries*
+
+        The transactions of all entries form one chain and are sent in one
+        ordered batch. Entries that would make the unconfirmed chain too
+        long are deferred to a later batch, unless nothing is in flight:
+        then as many chunks as fit are sent and the rest waits for their
+        confirmation. Entries whose transactions the node refused are
+        deferred too.
+        '''
+
+        in_flight = self._unconfirmed()
+        if self.head is None:
+            self.head, self.addrs, _ = commit_transaction.prepare_data()
+            if self.head is None:
+                raise InsufficientFunds()
+
+        batch = []
+        # Oldest first, an entry can be both deferred and queued again
+        entries = sorted(set(entries))
+        for i, entry in enumerate(entries):
+            found = self._read_file(entry)
+            if found is None:
+                continue
+            data, stored = found
+            chunks = commit_transaction.chunk_data(data)[stored:]
+            if in_flight + len(chunks) > MAX_CHAIN_TXS:
+                if in_flight:
+                    # Wait for confirmations, poll_interval from now
+                    self.deferred.extend(entries[i:])
+                    break
+                chunks = chunks[:MAX_CHAIN_TXS]
+            try:
+                txs = commit_transaction.create_chained_txs(self.head, self.addrs,
+                                                            b''.join(chunks))
+            except InsufficientFunds as exc:
+                self._journal("UPDATE chain_journal SET state='failed', error=? WHERE id=?",
+                              (str(exc), entry))
+                continue
+            self.head = txs[-1].tx_outs_as_spendable()[0]
+            in_flight += len(txs)
+            txids = [tx.id() for tx in txs]
+            raw = [tx.as_hex(True) for tx in txs]
+            # The contents are kept until they are confirmed, in case only
+            # a part of them makes it into the mempool
+            if self._journal("UPDATE chain_journal SET state='signed', txids=?, raw=?, "
+                             "data=? WHERE id=?", (json.dumps(txids), json.dumps(raw),
+                                                   data, entry)) is None:
+                return
+            batch.append((entry, txids, raw))
+
+        if not batch:
+            return
+        results = commit_transaction.get_rpc().map(
+            'sendrawtransaction', [[tx, 1] for _, _, raw in batch for tx in raw],
+            concurrent=False)
+        if None in results:
+            # The node refused a transaction, and with it the ones spending
+            # it. What it accepted before is sent, the rest is built again
+            # on the new head.
+            log.warning('Node refused %d of %d transactions', results.count(None),
+                        len(results))
+            self.head = None
+        now = time()
+        sent = 0
+        for entry, txids, _ in batch:
+            accepted = results[sent:sent + len(txids)]
+            sent += len(txids)
+            if None in accepted:
+                accepted = accepted[:accepted.index(None)]
+            if accepted:
+                self._journal("UPDATE chain_journal SET state='sent', sent_at=?, txids=? "
+                              "WHERE id=?", (now, json.dumps(txids[:len(accepted)]), entry))
+            else:
+                self._retry(entry)
+                self.deferred.append(entry)
+        log.info('Sent %d transactions for %d files', len(results), len(batch))
+
+    def _retry(self, entry):
+        '''Make *entry* pending again after its transactions got lost'''
+
+        # Nothing of the file is on chain yet, so its newest contents can
+        # be stored instead
+        self._journal("UPDATE chain_journal SET state='pending', txids=NULL, raw=NULL, "
+                      "sent_at=NULL, data=CASE WHEN stored THEN data END WHERE id=?",
+                      (entry,))
+
+    def track_confirmations(self):
+        '''Mark sent entries confirmed, or pending again if the node does
+        not know their transactions or they have another part to send
+
+        Returns the entries that are pending again.
+        '''
+
+        rows = self._journal("SELECT id, txids, data, stored FROM chain_journal "
+                             "WHERE state='sent'") or []
+        if not rows:
+            return []
+        pending = []
+        last = [json.loads(txids)[-1] for _, txids, _, _ in rows]
+        txs = commit_transaction.get_rpc().map('getrawtransaction',
+                                               [[txid, 1] for txid in last])
+        for (entry, txids, data, stored), tx in zip(rows, txs):
+            if tx is None:
+                log.warning('Transactions of journal entry %d were lost, resending', entry)
+                self.head = None
+                self._retry(entry)
+                pending.append(entry)
+            elif tx.get('confirmations', 0) < self.confirmations:
+                continue
+            elif data is not None and (stored + len(json.loads(txids))
+                                       < len(commit_transaction.chunk_data(data))):
+                # Send the next part
+                self._journal("UPDATE chain_journal SET state='pending', stored=?, "
+                              "txids=NULL, raw=NULL, sent_at=NULL WHERE id=?",
+                              (stored + len(json.loads(txids)), entry))
+                pending.append(entry)
+            else:
+                self._journal("UPDATE chain_journal SET state='confirmed', confirmed_at=?, "
+                              "data=NULL WHERE id=?", (time(), entry))
+        return pending
@@ -0,0 +1,128 @@
+import os
+import re
+import errno
+import stat
+import logging
+
+import llfuse
+from llfuse import FUSEError
+
+from hello_fuse import Operations
+import commit_transaction
+
+log = logging.getLogger()
+
+TXID_RE = re.compile(b'^[0-9a-f]{64}$')
+
+DIR_MODE = (stat.S_IFDIR | stat.S_IRUSR | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP
+            | stat.S_IROTH | stat.S_IXOTH)
+FILE_MODE = stat.S_IFREG | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+LINK_MODE = (stat.S_IFLNK | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR |
+             stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP |
+             stat.S_IROTH | stat.S_IWOTH | stat.S_IXOTH)
+
+
+class MountOwner(object):
+    '''Stands in for the request context when creating cached entries'''
+
+    def __init__(self):
+        self.uid = os.getuid()
+        self.gid = os.getgid()
+
+
+class ChainOperations(Operations):
+    '''Read-only view of the messages stored on chain
+
+    The root holds a HEAD symlink to the newest message and one directory
+    per transaction, named by its txid. Each directory holds the OP_RETURN
+    payload as `data` and, for every input N, a `prev.N` symlink to the
+    transaction that input spends.
+
+    A transaction is only fetched the first time its directory is looked
+    up, then kept in the file system tables. `cat HEAD/data` costs one
+    transaction, and `ls` of the root only lists what is already cached.
+    '''
+
+    def __init__(self, db_path=':memory:', **db_options):
+        super(ChainOperations, self).__init__(db_path, **db_options)
+        self.owner = MountOwner()
+        self._update_head()
+
+    def _update_head(self):
+        sp, _, last_script = commit_transaction.prepare_data()
+        if last_script is None:
+            log.info('No message found on chain')
+            return
+
+        target = commit_transaction.sp_txid(sp).encode('ascii')
+        with self.cm.transaction():
+            try:
+                inode = self.cm.lookup(llfuse.ROOT_INODE, b'HEAD')
+            except FUSEError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+            else:
+                self.cm.delete_contents(b'HEAD', llfuse.ROOT_INODE)
+                self.cm.delete_inodes(inode)
+            self.cm._create(llfuse.ROOT_INODE, b'HEAD', self.owner, LINK_MODE,
+                            target=target)
+
+    def _load_tx(self, txid):
+        # Other requests can go on while the node answers
+        with llfuse.lock_released:
+            tx = commit_transaction.get_tx(txid.decode('ascii'))
+        if tx is None:
+            raise FUSEError(errno.ENOENT)
+        scripts = [out['scriptPubKey'] for out in tx['vout']
+                   if commit_transaction.has_op_return(out)]
+        if not scripts:
+            raise FUSEError(errno.ENOENT)
+
+        # Another request may have loaded it meanwhile
+        try:
+            self.cm.lookup(llfuse.ROOT_INODE, txid)
+        except FUSEError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        else:
+            return
+
+        with self.cm.transaction():
+            inode = self.cm._create(llfuse.ROOT_INODE, txid, self.owner, DIR_MODE)
+            data = self.cm._create(inode, b'data', self.owner, FILE_MODE)
+            payload = commit_transaction.extract_msg(scripts[0])
+            if payload:
+                self.cm._write(data, 0, payload)
+            for n, vin in enumerate(tx['vin']):
+                if 'txid' in vin: # Coinbase
+                    self.cm._create(inode, b'prev.%d' % n, self.owner, LINK_MODE,
+                                    target=b'../' + vin['txid'].encode('ascii'))
+
+    def lookup(self, inode_p, name):
+        try:
+            return super(ChainOperations, self).lookup(inode_p, name)
+        except FUSEError as exc:
+            if (exc.errno != errno.ENOENT or inode_p != llfuse.ROOT_INODE
+                or not TXID_RE.match(name)):
+                raise
+        self._load_tx(name)
+        return super(ChainOperations, self).lookup(inode_p, name)
+
+    def open(self, inode, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise FUSEError(errno.EROFS)
+        return super(ChainOperations, self).open(inode, flags)
+
+    def _read_only(self, *a, **kw):
+        raise FUSEError(errno.EROFS)
+
+    setattr = _read_only
+    mknod = _read_only
+    mkdir = _read_only
+    create = _read_only
+    symlink = _read_only
+    rename = _read_only
+    link = _read_only
+    unlink = _read_only
+    rmdir = _read_only
+    write = _read_only
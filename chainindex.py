@@ -0,0 +1,242 @@
+import sqlite3
+import threading
+
+# Blocks fetched from the node per round trip while syncing
+SYNC_BLOCKS = 50
+
+
+def output_address(out):
+    script = out['scriptPubKey']
+    if 'address' in script:
+        return script['address']
+    addresses = script.get('addresses')
+    return addresses[0] if addresses else None
+
+
+class ChainIndexError(Exception):
+    pass
+
+
+class ChainIndex(object):
+    '''Local index of the wallet's outputs and OP_RETURN payloads
+
+    Kept up to date block by block from the node with sync(), so that
+    finding spendable outputs or the newest payload does not need a scan
+    of the wallet. The hash of every indexed block is kept to detect
+    reorganisations, whose blocks are rolled back before syncing on.
+    Only confirmed transactions are indexed, the wallet's transactions in
+    the mempool are looked up from the node by unspent() and head(), so
+    that outputs they spend are not offered again. Can be shared between
+    threads.
+    '''
+
+    def __init__(self, path, rpc, start_height=0):
+        self.rpc = rpc
+        self.start_height = start_height
+        # Reentrant, sync() calls the other methods
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.init_tables()
+
+    def init_tables(self):
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS blocks (
+            height    INTEGER PRIMARY KEY,
+            hash      TEXT NOT NULL
+        )""")
+
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS addresses (
+            address   TEXT PRIMARY KEY
+        )""")
+
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS utxos (
+            txid      TEXT NOT NULL,
+            vout      INT NOT NULL,
+            address   TEXT NOT NULL,
+            amount    REAL NOT NULL,
+            script    TEXT NOT NULL,
+            height    INT NOT NULL,
+            spent_height INT,
+
+            PRIMARY KEY (txid, vout)
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS utxos_unspent ON utxos (spent_height)")
+
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS payloads (
+            txid      TEXT PRIMARY KEY,
+            script    TEXT NOT NULL,
+            height    INT NOT NULL,
+            position  INT NOT NULL
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS payloads_order "
+                        "ON payloads (height, position)")
+
+    def watch(self, addresses):
+        '''Index outputs paying to *addresses* from now on'''
+
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO addresses (address) VALUES (?)",
+                                [(addr,) for addr in addresses])
+
+    def last_block(self):
+        with self.lock:
+            row = self.db.execute("SELECT height, hash FROM blocks "
+                                  "ORDER BY height DESC LIMIT 1").fetchone()
+            return row if row is not None else (self.start_height - 1, None)
+
+    def rollback(self, height):
+        '''Forget every block from *height* on'''
+
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.execute("DELETE FROM utxos WHERE height>=?", (height,))
+            self.db.execute("UPDATE utxos SET spent_height=NULL WHERE spent_height>=?",
+                            (height,))
+            self.db.execute("DELETE FROM payloads WHERE height>=?", (height,))
+            self.db.execute("DELETE FROM blocks WHERE height>=?", (height,))
+            self.db.execute('COMMIT')
+
+    def sync(self):
+        '''Index the blocks the node has and this index does not'''
+
+        with self.lock:
+            # Walk back until our chain agrees with the node's
+            height, block_hash = self.last_block()
+            while block_hash is not None and self.rpc.call('getblockhash', [height]) != block_hash:
+                self.rollback(height)
+                height, block_hash = self.last_block()
+
+            tip = self.rpc.call('getblockcount')
+            while height < tip:
+                heights = list(range(height + 1, min(height + SYNC_BLOCKS, tip) + 1))
+                hashes = self.rpc.map('getblockhash', [[h] for h in heights])
+                # Verbosity 2 includes the decoded transactions, which works
+                # without -txindex and saves a round trip per transaction
+                blocks = self.rpc.map('getblock', [[h, 2] for h in hashes])
+                for h, block in zip(heights, blocks):
+                    if block is None:
+                        raise ChainIndexError('Node did not return block %d' % h)
+
+                # A block that no longer extends our chain means a reorg
+                # happened while syncing, go back and check again
+                prev = block_hash
+                for block in blocks:
+                    if prev is not None and block.get('previousblockhash') != prev:
+                        return self.sync()
+                    prev = block['hash']
+
+                self.db.execute('BEGIN')
+                for h, block in zip(heights, blocks):
+                    for position, tx in enumerate(block['tx']):
+                        self.index_tx(tx, h, position)
+                    self.db.execute("INSERT INTO blocks (height, hash) VALUES (?,?)",
+                                    (h, block['hash']))
+                self.db.execute('COMMIT')
+                height, block_hash = heights[-1], blocks[-1]['hash']
+
+    def index_tx(self, tx, height, position):
+        ours = False
+        for vin in tx['vin']:
+            if 'txid' not in vin: # Coinbase
+                continue
+            cur = self.db.execute("UPDATE utxos SET spent_height=? WHERE txid=? AND vout=?",
+                                  (height, vin['txid'], vin['vout']))
+            ours = ours or cur.rowcount > 0
+
+        payload = None
+        for out in tx['vout']:
+            script = out['scriptPubKey']['hex']
+            if script[:2] == '6a': # OP_RETURN
+                payload = payload or script
+                continue
+            address = output_address(out)
+            if address is None or self.db.execute("SELECT 1 FROM addresses WHERE address=?",
+                                                  (address,)).fetchone() is None:
+                continue
+            ours = True
+            self.db.execute("INSERT OR REPLACE INTO utxos (txid, vout, address, amount, "
+                            "script, height) VALUES (?,?,?,?,?,?)",
+                            (tx['txid'], out['n'], address, out['value'], script, height))
+
+        if ours and payload is not None:
+            self.db.execute("INSERT OR REPLACE INTO payloads (txid, script, height, position) "
+                            "VALUES (?,?,?,?)", (tx['txid'], payload, height, position))
+
+    def mempool(self):
+        '''Return (outputs spent, unspent outputs, payloads) of the wallet's
+        transactions in the mempool
+
+        The unspent outputs are in listunspent format, the payloads are
+        (txid, OP_RETURN script hex) of the transactions whose outputs are
+        unspent. Chains of unconfirmed transactions are followed back to
+        their confirmed inputs. Transactions paying nothing back to the
+        wallet are not found.
+        '''
+
+        keys = ('txid', 'vout', 'address', 'amount', 'scriptPubKey')
+        utxos = [dict((k, u[k]) for k in keys) for u in self.rpc.call('listunspent', [0, 0])]
+        spent = set()
+        payloads = []
+        txids = list(set(u['txid'] for u in utxos))
+        seen = set(txids)
+        tips = True
+        while txids:
+            parents = []
+            for tx in self.rpc.map('getrawtransaction', [[txid, 1] for txid in txids]):
+                if tx is None or tx.get('confirmations', 0) > 0:
+                    continue
+                for vin in tx['vin']:
+                    if 'txid' not in vin: # Coinbase
+                        continue
+                    spent.add((vin['txid'], vin['vout']))
+                    if vin['txid'] not in seen:
+                        seen.add(vin['txid'])
+                        parents.append(vin['txid'])
+                scripts = [out['scriptPubKey']['hex'] for out in tx['vout']]
+                payload = next((script for script in scripts if script[:2] == '6a'), None)
+                if tips and payload is not None:
+                    payloads.append((tx['txid'], payload))
+            txids = parents
+            tips = False
+        return spent, utxos, payloads
+
+    def unspent(self):
+        '''Return the unspent outputs in listunspent format'''
+
+        with self.lock:
+            spent, pending, _ = self.mempool()
+            rows = self.db.execute("SELECT txid, vout, address, amount, script FROM utxos "
+                                   "WHERE spent_height IS NULL ORDER BY height, txid, vout")
+            return [{'txid': txid, 'vout': vout, 'address': address, 'amount': amount,
+                     'scriptPubKey': script} for txid, vout, address, amount, script in rows
+                    if (txid, vout) not in spent] + pending
+
+    def head(self):
+        '''Return (utxo, OP_RETURN script hex) of the newest unspent payload
+
+        None if there is none. Payloads in the mempool are newer than the
+        confirmed ones, among them the one that entered it last wins.
+        '''
+
+        with self.lock:
+            spent, pending, payloads = self.mempool()
+            if payloads:
+                times = self.rpc.map('getmempoolentry', [[txid] for txid, _ in payloads])
+                txid, payload = max(zip(payloads, times),
+                                    key=lambda p: p[1]['time'] if p[1] is not None else 0)[0]
+                utxo = min((u for u in pending if u['txid'] == txid), key=lambda u: u['vout'])
+                return utxo, payload
+
+            rows = self.db.execute("SELECT u.txid, u.vout, u.address, u.amount, u.script, "
+                                   "p.script FROM payloads p JOIN utxos u ON u.txid = p.txid "
+                                   "WHERE u.spent_height IS NULL "
+                                   "ORDER BY p.height DESC, p.position DESC")
+            for txid, vout, address, amount, script, payload in rows:
+                if (txid, vout) in spent:
+                    continue
+                return ({'txid': txid, 'vout': vout, 'address': address, 'amount': amount,
+                         'scriptPubKey': script}, payload)
+            return None
@@ -0,0 +1,123 @@
+'''Fee estimation and coin selection for data transactions
+
+Sizes are for pay-to-pubkey-hash inputs and outputs of non-segwit
+transactions, so virtual size and size are the same. Values and fees are
+in the smallest coin unit.
+'''
+
+TX_OVERHEAD = 14  # version, time, lock time, input and output counts
+INPUT_SIZE = 148
+OUTPUT_SIZE = 34
+OP_RETURN_OVERHEAD = 11  # value, script length, OP_RETURN and push opcodes
+
+# Give up searching for a better match after this many branches
+BNB_MAX_TRIES = 100000
+
+
+class InsufficientFunds(Exception):
+    def __str__(self):
+        return 'Not enough spendable coins to pay for the transaction'
+
+
+def outpoint(sp):
+    return (sp.tx_hash, sp.tx_out_index)
+
+
+def tx_size(n_inputs, n_outputs, payload_len=None):
+    size = TX_OVERHEAD + n_inputs * INPUT_SIZE + n_outputs * OUTPUT_SIZE
+    if payload_len is not None:
+        size += OP_RETURN_OVERHEAD + payload_len
+    return size
+
+
+def fee_for_size(size, fee_per_kb):
+    # Round up, nodes reject fees below their rate
+    return (size * fee_per_kb + 999) // 1000
+
+
+def largest_first(candidates, needed, input_fee):
+    '''Return the fewest largest coins covering *needed*'''
+
+    selected = []
+    for sp in sorted(candidates, key=lambda sp: sp.coin_value, reverse=True):
+        if needed <= 0:
+            break
+        selected.append(sp)
+        needed -= sp.coin_value - input_fee
+    return selected if needed <= 0 else None
+
+
+def branch_and_bound(candidates, needed, input_fee, tolerance):
+    '''Return coins whose value, net of their fee, exceeds *needed* by at
+    most *tolerance*, with the least excess found. None if there are none.
+    '''
+
+    coins = sorted(candidates, key=lambda sp: sp.coin_value, reverse=True)
+    values = [sp.coin_value - input_fee for sp in coins]
+    # remaining[i] is what coins[i:] can still add
+    remaining = [0] * (len(values) + 1)
+    for i in range(len(values) - 1, -1, -1):
+        remaining[i] = remaining[i + 1] + max(values[i], 0)
+
+    # Depth first over include/exclude decisions, largest coins first. A
+    # stack instead of recursion, wallets can hold thousands of coins.
+    best_excess, best = None, None
+    stack = [(0, 0, ())]
+    tries = 0
+    while stack and tries < BNB_MAX_TRIES:
+        tries += 1
+        i, total, chosen = stack.pop()
+        if total >= needed:
+            if total - needed <= tolerance and (best is None or total - needed < best_excess):
+                best_excess, best = total - needed, chosen
+            continue
+        if i == len(values) or total + remaining[i] < needed:
+            continue
+        stack.append((i + 1, total, chosen))
+        if values[i] > 0:
+            stack.append((i + 1, total + values[i], chosen + (i,)))
+
+    return None if best is None else [coins[i] for i in best]
+
+
+def select_coins(required, candidates, fee_per_kb, n_outputs, payload_len=None,
+                 needed=0, strategy='bnb', consolidate=0):
+    '''Pick the inputs of a transaction
+
+    *required* coins are always spent. Further coins come from *candidates*
+    until the inputs pay for *needed* plus the fee of a transaction with
+    *n_outputs* outputs and an OP_RETURN payload of *payload_len* bytes.
+    The strategy is 'bnb' (branch and bound, falling back to largest
+    first) or 'largest-first'. Up to *consolidate* more of the smallest
+    coins that are worth more than the fee to spend them are then added,
+    to keep the wallet from fragmenting.
+
+    Returns (inputs, fee), raises InsufficientFunds if the coins do not
+    cover it.
+    '''
+
+    input_fee = fee_for_size(INPUT_SIZE, fee_per_kb)
+    base_fee = fee_for_size(tx_size(len(required), n_outputs, payload_len), fee_per_kb)
+    short = needed + base_fee - sum(sp.coin_value for sp in required)
+
+    chosen = set(outpoint(sp) for sp in required)
+    candidates = [sp for sp in candidates if outpoint(sp) not in chosen]
+    extra = []
+    if short > 0:
+        if strategy == 'bnb':
+            extra = branch_and_bound(candidates, short, input_fee, input_fee)
+        if not extra:
+            extra = largest_first(candidates, short, input_fee)
+        if extra is None:
+            raise InsufficientFunds()
+
+    if consolidate:
+        chosen.update(outpoint(sp) for sp in extra)
+        small = sorted((sp for sp in candidates if outpoint(sp) not in chosen
+                        and sp.coin_value > input_fee),
+                       key=lambda sp: sp.coin_value)
+        extra = extra + small[:consolidate]
+
+    inputs = list(required) + extra
+    fee = fee_for_size(tx_size(len(inputs), n_outputs, payload_len), fee_per_kb)
+    return inputs, fee
@@ -1,20 +1,27 @@
-import requests
-import json
 from time import strptime, time
 from calendar import timegm
 import sys
+import os
 from binascii import hexlify
 from pycoin.tx import Spendable, tx_utils, TxOut
 from pycoin.tx.script import tools
 from pycoin.key import Key
 from binascii import unhexlify, hexlify
-from pycoin_ext import LazySecretExponentDB
+from pycoin_ext import SecretExponentDB
+from rpcclient import RPCClient
+from txcache import TxCache
+from chainindex import ChainIndex
+from coinselect import select_coins, fee_for_size, tx_size
 from config import config
 
 now = int(time())
 
+COIN = 10**6 # Smallest units per coin
+MSG_VALUE = 10**4 # Value carried by the OP_RETURN output
+MIN_CHANGE = 10**4 # Keeps the change output, which the next message spends, above dust
+
 def create_spend(utxo):
-  sp = Spendable(coin_value   = utxo['amount'] * 10**6,
+  sp = Spendable(coin_value   = int(round(utxo['amount'] * COIN)),
                  script       = unhexlify(utxo['scriptPubKey']),
                  tx_hash      = unhexlify(utxo['txid'])[::-1],
                  tx_out_index = utxo['vout'])
@@ -28,75 +35,281 @@ def create_spend_from_tx(tx, index):
           'vout': index}
   return create_spend(utxo)
 
+rpc_client = None
+tx_cache = None
+chain_index = None
+key_db = None
+
+WIF_PREFIXES = [b'\x34', b'\x44']
+
+def get_rpc():
+  global rpc_client
+  if rpc_client is None:
+    rpc_client = RPCClient(config['coinuri'],
+                           timeout = config.get('rpc_timeout', 30))
+  return rpc_client
+
 def do_rq(method, params = []):
-  to_json = {'method': method, 'params': params, 'id': 1}
-  r = requests.post(config['coinuri'], data = json.dumps(to_json))
-  return r.json()['result']
+  return get_rpc().call(method, params)
+
+def get_tx_cache():
+  global tx_cache
+  if tx_cache is None:
+    tx_cache = TxCache(config.get('txcache', 'txcache.db'))
+  return tx_cache
+
+def get_index():
+  global chain_index
+  if chain_index is None:
+    chain_index = ChainIndex(config['index'], get_rpc(),
+                             config.get('index_start_height', 0))
+    received = do_rq('listreceivedbyaddress', [0, True])
+    chain_index.watch([i['address'] for i in received])
+  return chain_index
+
+def get_txs(txids):
+  cache = get_tx_cache()
+  found = cache.get_many(txids)
+  missing = [txid for txid in set(txids) if txid not in found]
+  if missing:
+    txs = get_rpc().map('getrawtransaction', [[txid, 1] for txid in missing])
+    cache.put_many(txs)
+    found.update(zip(missing, txs))
+  return [found[txid] for txid in txids]
+
+def get_tx(txid):
+  return get_txs([txid])[0]
 
+def sp_txid(sp):
+  return hexlify(sp.tx_hash[::-1]).decode('utf-8')
+
+def has_op_return(out):
+  return out['scriptPubKey']['hex'][:2] == '6a'
+
+def walk_chain(sps, ancestors = True):
+  """Yield (spendable, OP_RETURN script) for every data output of the
+  transactions of sps, then of their data-carrying ancestors.
+
+  The walk is breadth first, newest generation first and inputs in order,
+  and visits each transaction once. Each generation is fetched in one
+  batch, only when the caller asks for it.
+  """
+  txids = [sp_txid(sp) for sp in sps]
+  seen = set()
+  wave = []
+  for sp, tx in zip(sps, get_txs(txids)):
+    if tx['txid'] not in seen:
+      seen.add(tx['txid'])
+      wave.append((sp, tx))
+  while wave:
+    vins = []
+    for sp, tx in wave:
+      data = [out for out in tx['vout'] if has_op_return(out)]
+      for out in data:
+        yield sp, out['scriptPubKey']
+      if data and ancestors:
+        for vin in tx['vin']:
+          if 'txid' in vin and vin['txid'] not in seen: # Skip coinbase
+            seen.add(vin['txid'])
+            vins.append(vin)
+    wave = []
+    for vin, old_tx in zip(vins, get_txs([vin['txid'] for vin in vins])):
+      if any(has_op_return(out) for out in old_tx['vout']):
+        wave.append((create_spend_from_tx(old_tx, vin['vout']), old_tx))
 
 def search_last_tx_data(sps, full_tx = False):
-  sp_data = []
-  for sp in sps:
-    tx = do_rq('getrawtransaction', [hexlify(sp.tx_hash[::-1]).decode('utf-8'), 1])
-    for out in tx['vout']:
-      if out['scriptPubKey']['hex'][:2] == '6a': # Check for OP_RETURN
-        sp_data.append((sp, out['scriptPubKey']))
-        if full_tx:
-          for vin in tx['vin']:
-            old_tx = do_rq('getrawtransaction', [vin['txid'], 1])
-            old_sp = create_spend_from_tx(old_tx, vin['vout'])
-            last_sp, last_script = search_last_tx_data([old_sp])
-            if last_script != None:
-              sps.append(last_sp)
-  if len(sp_data) > 0: # TODO configure which one to choose
-    return sp_data if full_tx else sp_data[0]
-  return sps[0], None
+  if full_tx:
+    return list(walk_chain(sps))
+  found = list(walk_chain(sps, ancestors = False))
+  if len(found) == 0:
+    return sps[0], None
+  if len(found) == 1:
+    return found[0]
+  # Continue from the newest message, the other ones are left over from
+  # earlier forks and get spent by coin selection in time
+  txs = get_txs([sp_txid(sp) for sp, _ in found])
+  keys = tx_order(txs)
+  return found[max(range(len(found)), key = lambda i: keys[i])]
+
+def get_blocks(txs, blocks):
+  """Add the blocks of txs missing from blocks, by hash"""
+  hashes = list(set(tx['blockhash'] for tx in txs
+                    if 'blockhash' in tx and tx['blockhash'] not in blocks))
+  blocks.update(zip(hashes, get_rpc().map('getblock', [[h, 1] for h in hashes])))
+
+def tx_order(txs):
+  """Return a sort key for each of txs, the newest has the largest.
+
+  Confirmed transactions are ordered by block height and position in
+  their block, asked from the node since cached transactions only know
+  their block hash. Unconfirmed ones come after them, by the time they
+  entered the mempool. Transactions the node has in neither come first.
+  """
+  blocks = {}
+  get_blocks(txs, blocks)
+  def in_chain(tx):
+    block = blocks.get(tx.get('blockhash'))
+    # Blocks that were reorganised away have negative confirmations
+    return block is not None and block.get('confirmations', 0) >= 0
+  unconfirmed = [tx['txid'] for tx in txs if not in_chain(tx)]
+  entries = dict(zip(unconfirmed, get_rpc().map('getmempoolentry',
+                                                [[txid] for txid in unconfirmed])))
+  # The cached copy of a transaction whose block was reorganised away
+  # names that block, it may be in another one by now
+  stale = [txid for txid in unconfirmed if entries[txid] is None]
+  if stale:
+    get_tx_cache().discard(stale)
+    fresh = dict((tx['txid'], tx) for tx in get_txs(stale) if tx is not None)
+    txs = [fresh.get(tx['txid'], tx) for tx in txs]
+    get_blocks(fresh.values(), blocks)
+  keys = []
+  for tx in txs:
+    if entries.get(tx['txid']) is not None:
+      keys.append((1, entries[tx['txid']]['time'], 0))
+    elif in_chain(tx):
+      block = blocks[tx['blockhash']]
+      keys.append((0, block['height'], block['tx'].index(tx['txid'])))
+    else:
+      # Gone, never continue from it
+      keys.append((-1, 0, 0))
+  return keys
 
 def get_wifs(addrs):
+  addrs = list(addrs)
   lst = []
-  for addr in addrs:
-    wif = do_rq('dumpprivkey', [addr])
+  for addr, wif in zip(addrs, get_rpc().map('dumpprivkey', [[addr] for addr in addrs])):
     if wif == None:
       continue
     lst.append((addr, wif.rstrip()))
   return lst
 
-# TODO
+def get_key_db(addrs):
+  """Return the session's key store, holding the keys of all of addrs.
+
+  Only keys not seen yet this session are dumped from the node, in a
+  single batch. With config['keystore'] set the keys are kept encrypted
+  on disk across sessions.
+  """
+  global key_db
+  path = config.get('keystore')
+  if key_db is None:
+    key_db = SecretExponentDB()
+    if path is not None and os.path.exists(path):
+      key_db.load(path, config['keystore_password'])
+  missing = [addr for addr in addrs if not key_db.has(addr)]
+  if missing:
+    key_db.add_wifs(get_wifs(missing), WIF_PREFIXES)
+    if path is not None:
+      key_db.save(path, config['keystore_password'])
+  return key_db
+
+def change_addr(addrs, keys):
+  return next(addr for addr in addrs if keys.has(addr))
+
+# Largest payload a single OP_RETURN output carries
+MAX_MSG = 80
+
+# Used when the node has no estimate, overridden by config['fee_per_kb']
 fee_per_kb = 10**5
-def estimate_fee(sps, to_addrs):
-  #fee_kb = (len(sps) * 119 >> 10) * fee_per_kb
-  #print((len(sps),fee_kb), file=sys.stderr)
-  return 1 
-  return fee_per_kb
+def get_fee_per_kb():
+  est = do_rq('estimatesmartfee', [6])
+  if est is not None and 'feerate' in est:
+    return int(est['feerate'] * COIN)
+  est = do_rq('estimatefee', [6])
+  if est is not None and est > 0:
+    return int(est * COIN)
+  return config.get('fee_per_kb', fee_per_kb)
+
+def get_spendables():
+  if 'index' in config:
+    return [create_spend(utxo) for utxo in get_index().unspent()]
+  return get_utxos()[0]
+
+def select_inputs(sp, msg_len, needed, pool):
+  if pool is None:
+    pool = get_spendables()
+  return select_coins([sp], pool, get_fee_per_kb(), 1, msg_len, needed,
+                      strategy = config.get('coin_selection', 'bnb'),
+                      consolidate = config.get('consolidate', 0))
 
 def extract_msg(script):
   msg_hex   = unhexlify(script['hex'])
   opcode, msg, _ = tools.get_opcode(msg_hex, 1)
+  # Single bytes up to 16 are pushed as OP_0 and OP_1 to OP_16
+  if opcode == 0:
+    msg = b'\x00'
   if 0x51 <= opcode and opcode <= 0x60:
     msg = bytes(chr(opcode - 0x50), 'utf-8')
   return msg
 
 def format_msg(msg):
-  op = 'OP_RETURN %s' % msg
+  # Bracketed, or hex that is all digits would be compiled as a number
+  op = 'OP_RETURN [%s]' % msg
   op = tools.compile(op)
   return TxOut(10**4, op)
 
-def create_tx(sp, addrs, msg):
-  addrs_wifs = get_wifs(addrs)
-  addrs, wifs = zip(*addrs_wifs)
-  fee = estimate_fee([sp], addrs[:1])
-  tx = tx_utils.create_tx([sp], [addrs[:1][0]], fee=fee, time=now)
-  tx.txs_out[0].coin_value -= 2 * 10**4
+def build_tx(sps, addr, msg, fee):
+  tx = tx_utils.create_tx(sps, [addr], fee=fee, time=now)
+  tx.txs_out[0].coin_value -= MSG_VALUE
   tx.txs_out.append(format_msg(msg))
-  wifs=[wifs[0]]
-  tx.sign(LazySecretExponentDB(wifs, {}, [b'\x34', b'\x44']))
+  return tx
+
+def check_signatures(tx):
   for idx, tx_out in enumerate(tx.txs_in):
       if not tx.is_signature_ok(idx):
           print('failed to sign spendable for %s' %
                                       tx.unspents[idx].bitcoin_address(),
                                       file=sys.stderr)
+
+def create_tx(sp, addrs, msg, pool = None):
+  """Build a signed transaction storing msg (hex) that spends sp, plus
+  whatever coins of pool (default: the wallet) are needed for the fee."""
+  sps, fee = select_inputs(sp, len(msg) // 2, MSG_VALUE + MIN_CHANGE, pool)
+  keys = get_key_db(addrs)
+  tx = build_tx(sps, change_addr(addrs, keys), msg, fee)
+  tx.sign(keys)
+  check_signatures(tx)
   return tx
 
+def chunk_data(data, size = MAX_MSG):
+  return [data[i:i + size] for i in range(0, len(data), size)]
+
+def create_chained_txs(sp, addrs, data, pool = None):
+  """Build and sign one transaction per OP_RETURN sized chunk of data.
+
+  Each transaction spends the change output of the one before, so the
+  whole chain can be built and submitted without waiting on the node.
+  """
+  chunks = chunk_data(data)
+  rate = get_fee_per_kb()
+  # The first transaction brings in the funds for the whole chain
+  later = sum(MSG_VALUE + fee_for_size(tx_size(1, 1, len(chunk)), rate)
+              for chunk in chunks[1:])
+  sps, fee = select_inputs(sp, len(chunks[0]), MSG_VALUE + later + MIN_CHANGE, pool)
+  keys = get_key_db(addrs)
+  addr = change_addr(addrs, keys)
+  txs = []
+  for i, chunk in enumerate(chunks):
+    if i > 0:
+      fee = fee_for_size(tx_size(1, 1, len(chunk)), rate)
+    tx = build_tx(sps, addr, hexlify(chunk).decode('utf-8'), fee)
+    tx.sign(keys)
+    check_signatures(tx)
+    txs.append(tx)
+    sps = tx.tx_outs_as_spendable()[:1]
+  return txs
+
+def put_data(sp, addrs, data, pool = None):
+  """Store data of any length on chain, return the txids.
+
+  All transactions go out in one ordered JSON-RPC batch, parents first.
+  The node may refuse chains longer than its mempool ancestor limit
+  (25 by default), those transactions get None.
+  """
+  txs = create_chained_txs(sp, addrs, data, pool)
+  return get_rpc().map('sendrawtransaction', [[tx.as_hex(True), 1] for tx in txs],
+                       concurrent = False)
+
 def get_utxos():
   utxos = do_rq('listunspent', [0])
   addrs = set()
@@ -115,10 +328,13 @@ def get_msg():
   if len(sys.argv) != 2:
     usage()
   msg = sys.argv[1]
-  msg_b = bytes(msg, ('utf-8'))
-  if len(msg_b) > 80 or len(msg_b) == 0:
+  if msg == '-':
+    msg_b = sys.stdin.buffer.read()
+  else:
+    msg_b = bytes(msg, ('utf-8'))
+  if len(msg_b) == 0:
     usage()
-  return hexlify(msg_b).decode('utf-8')
+  return msg_b
 
 def print_last_msg(last_script):
   last_msg = extract_msg(last_script)
@@ -128,6 +344,15 @@ def print_last_msg(last_script):
     sys.stdout.buffer.write(last_msg)
 
 def prepare_data():
+  if 'index' in config:
+    index = get_index()
+    index.sync()
+    head = index.head()
+    if head is not None:
+      utxo, script = head
+      addrs = set(i['address'] for i in index.unspent())
+      return create_spend(utxo), addrs, {'hex': script}
+  # No index, or no head in it yet: scan the wallet
   sps, addrs = get_utxos()
   if len(sps) > 0:
     sp, last_script = search_last_tx_data(sps)
@@ -145,12 +370,12 @@ if __name__ == '__main__':
   sp, addrs, last_script = prepare_data()
   if len(sys.argv) == 1:
     if last_script is not None:
-      all_tx = search_last_tx_data([sp], True)
-      for _, script in all_tx:
+      for _, script in walk_chain([sp]):
         print_last_msg(script)
     exit(0)
   else:
     if sp != None:
-      print(auto_put_data(sp, addrs, get_msg()))
+      for txid in put_data(sp, addrs, get_msg()):
+        print(txid)
     else:
       print("No spendable output found", file=sys.stderr)
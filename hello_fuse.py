@@ -13,19 +13,21 @@ if (os.path.exists(os.path.join(basedir, 'setup.py')) and
 import llfuse
 import errno
 import stat
-from time import time
+from time import time, sleep
 import logging
+import threading
 from collections import defaultdict
 from llfuse import FUSEError
 from argparse import ArgumentParser
 
-from sqlmanager import SQLfs_Manager
+from sqlmanager import SQLfs_Manager, READDIR_PAGE_SIZE, BLOCK_SIZE
+from writeback import WriteBuffer
 
 log = logging.getLogger()
 
 
 class Operations(llfuse.Operations):
-    '''An example filesystem that stores all data in memory
+    '''An example filesystem that stores all data in an sqlite database
 
     This is a very simple implementation with terrible performance.
     Don't try to store significant amounts of data. Also, there are
@@ -37,41 +39,51 @@ class Operations(llfuse.Operations):
     '''
 
 
-    def __init__(self):
+    def __init__(self, db_path=':memory:', **db_options):
         super(Operations, self).__init__()
         self.inode_open_count = defaultdict(int)
-        self.cm = SQLfs_Manager()
+        # fh -> WriteBuffer holding data not yet written to the database
+        self.write_buffers = {}
+        # ChainCommitter storing written files on chain, if any, and the
+        # files written since they were last queued for it
+        self.chain_committer = None
+        self.chain_dirty = set()
+        self.cm = SQLfs_Manager(db_path, **db_options)
 
     def lookup(self, inode_p, name):
         inode = self.cm.lookup(inode_p, name)
         return self.getattr(inode)
 
     def getattr(self, inode):
-        row = self.cm.get_row('SELECT * FROM inodes WHERE id=?', (inode,))
+        if inode in self.write_buffers:
+            self._flush(inode)
 
+        entry = self.cm.attr_cache.get(inode)
+        if entry is not None:
+            return entry
+
+        return self._entry_from_row(self.cm.get_attr(inode))
+
+    def _entry_from_row(self, row):
+        # row holds the sqlmanager.ATTR_COLUMNS
         entry = llfuse.EntryAttributes()
-        entry.st_ino = inode
+        (entry.st_ino, entry.st_mode, entry.st_nlink, entry.st_uid, entry.st_gid,
+         entry.st_rdev, entry.st_size, entry.st_atime_ns, entry.st_mtime_ns,
+         entry.st_ctime_ns, allocated) = row
         entry.generation = 0
         entry.entry_timeout = 300
         entry.attr_timeout = 300
-        entry.st_mode = row['mode']
-        entry.st_nlink = self.cm.get_row("SELECT COUNT(inode) FROM contents WHERE inode=?",
-                                     (inode,))[0]
-        entry.st_uid = row['uid']
-        entry.st_gid = row['gid']
-        entry.st_rdev = row['rdev']
-        entry.st_size = row['size']
-
-        entry.st_blksize = 512
-        entry.st_blocks = 1
-        entry.st_atime_ns = row['atime_ns']
-        entry.st_mtime_ns = row['mtime_ns']
-        entry.st_ctime_ns = row['ctime_ns']
 
+        entry.st_blksize = BLOCK_SIZE
+        # Holes take no space. Only the last block can be short, and no
+        # block extends past the end of the file.
+        entry.st_blocks = (min(allocated * BLOCK_SIZE, entry.st_size) + 511) // 512
+
+        self.cm.attr_cache.put(entry.st_ino, entry)
         return entry
 
     def readlink(self, inode):
-        return self.cm.get_row('SELECT * FROM inodes WHERE id=?', (inode,))['target']
+        return self.cm.get_target(inode)
 
     def opendir(self, inode):
         return inode
@@ -80,10 +92,19 @@ class Operations(llfuse.Operations):
         if off == 0:
             off = -1
 
-        cursor = self.cm.get_contents_list(inode, off)
-
-        for row in cursor:
-            yield (row['name'], self.getattr(row['inode']), row['rowid'])
+        # Entries come a page at a time together with their attributes, and
+        # no cursor is held open between pages
+        while True:
+            rows = self.cm.get_contents_page(inode, off)
+            for row in rows:
+                off, name, attr = row[0], row[1], row[2:]
+                if attr[0] in self.write_buffers:
+                    entry = self.getattr(attr[0])
+                else:
+                    entry = self._entry_from_row(attr)
+                yield (name, entry, off)
+            if len(rows) < READDIR_PAGE_SIZE:
+                break
 
     def unlink(self, inode_p, name):
         entry = self.lookup(inode_p, name)
@@ -102,14 +123,15 @@ class Operations(llfuse.Operations):
         self._remove(inode_p, name, entry)
 
     def _remove(self, inode_p, name, entry):
-        if self.cm.get_row("SELECT COUNT(inode) FROM contents WHERE parent_inode=?",
-                        (entry.st_ino,))[0] > 0:
-            raise llfuse.FUSEError(errno.ENOTEMPTY)
+        with self.cm.transaction():
+            if self.cm.get_row("SELECT COUNT(inode) FROM contents WHERE parent_inode=?",
+                            (entry.st_ino,))[0] > 0:
+                raise llfuse.FUSEError(errno.ENOTEMPTY)
 
-        self.cm.delete_contents(name, inode_p)
+            self.cm.delete_contents(name, inode_p)
 
-        if entry.st_nlink == 1 and entry.st_ino not in self.inode_open_count:
-            self.cm.delete_inodes(entry.st_ino)
+            if entry.st_nlink == 1 and entry.st_ino not in self.inode_open_count:
+                self.cm.delete_inodes(entry.st_ino)
 
     def symlink(self, inode_p, name, target, ctx):
         mode = (stat.S_IFLNK | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR |
@@ -130,10 +152,13 @@ class Operations(llfuse.Operations):
             target_exists = True
 
         if target_exists:
-            self.cm.replace(inode_p_old, name_old, inode_p_new, name_new,
-                          entry_old, entry_new)
+            with self.cm.transaction():
+                self.cm.replace(inode_p_old, name_old, inode_p_new, name_new,
+                              entry_old, entry_new)
+                if entry_new.st_nlink == 1 and entry_new.st_ino not in self.inode_open_count:
+                    self.cm.delete_inodes(entry_new.st_ino)
         else:
-            self.cm.rename(self, name_new, inode_p_new, name_old, inode_p_old)
+            self.cm.rename(name_new, inode_p_new, name_old, inode_p_old)
 
 
     def link(self, inode, new_inode_p, new_name):
@@ -148,7 +173,10 @@ class Operations(llfuse.Operations):
         return self.getattr(inode)
 
     def setattr(self, inode, attr):
+        self._flush(inode)
         self.cm._setattr(inode, attr)
+        if self.chain_committer is not None and attr.st_size is not None:
+            self.chain_dirty.add(inode)
         return self.getattr(inode)
 
     def mknod(self, inode_p, name, mode, rdev, ctx):
@@ -163,14 +191,18 @@ class Operations(llfuse.Operations):
         stat_.f_bsize = 512
         stat_.f_frsize = 512
 
-        size = self.cm.get_row('SELECT SUM(size) FROM inodes')[0]
-        stat_.f_blocks = size // stat_.f_frsize
-        stat_.f_bfree = max(size // stat_.f_frsize, 1024)
+        size, inodes, allocated = self.cm.get_row('SELECT size, inodes, allocated '
+                                                  'FROM fs_stats')
+        # Like st_blocks, holes are not counted and partial blocks are
+        used = min(allocated * BLOCK_SIZE, size)
+        free = self.cm.free_space()
+        stat_.f_blocks = (used + free) // stat_.f_frsize
+        stat_.f_bfree = free // stat_.f_frsize
         stat_.f_bavail = stat_.f_bfree
 
-        inodes = self.cm.get_row('SELECT COUNT(id) FROM inodes')[0]
-        stat_.f_files = inodes
-        stat_.f_ffree = max(inodes , 100)
+        # Inodes are only limited by the space their rows take up
+        stat_.f_files = inodes + stat_.f_bfree
+        stat_.f_ffree = stat_.f_bfree
         stat_.f_favail = stat_.f_ffree
 
         return stat_
@@ -220,28 +252,82 @@ class Operations(llfuse.Operations):
         return self.getattr(inode)
 
     def read(self, fh, offset, length):
-        data = self.cm.get_row('SELECT data FROM inodes WHERE id=?', (fh,))[0]
-        if data is None:
-            data = b''
-        return data[offset:offset+length]
+        self._flush(fh)
 
-    def write(self, fh, offset, buf):
-        data = self.cm.get_row('SELECT data FROM inodes WHERE id=?', (fh,))[0]
-        if data is None:
-            data = b''
-        data = data[:offset] + buf + data[offset+len(buf):]
+        # Reads only use the calling thread's own connection, so they can
+        # run in parallel with other requests
+        with llfuse.lock_released:
+            return self.cm._read(fh, offset, length)
 
-        self.cm._write(fh, data)
+    def write(self, fh, offset, buf):
+        if buf:
+            wb = self.write_buffers.get(fh)
+            if wb is None:
+                wb = self.write_buffers[fh] = WriteBuffer()
+            wb.add(offset, buf)
+            if wb.is_full():
+                self._flush(fh)
+            if self.chain_committer is not None:
+                self.chain_dirty.add(fh)
 
         return len(buf)
 
+    def _flush(self, fh):
+        wb = self.write_buffers.pop(fh, None)
+        if wb is None:
+            return
+
+        with self.cm.transaction():
+            for offset, data in wb.extents:
+                self.cm._write(fh, offset, data)
+
+    def _flush_old(self):
+        '''Write out buffers that have been dirty for too long
+
+        Called from the commit loop's thread. The request thread's open
+        batch is committed first, and this thread's own right after, as an
+        open batch on either connection would lock out the other one.
+        '''
+
+        old = [fh for fh, wb in self.write_buffers.items() if wb.is_full()]
+        if not old:
+            return
+        self.cm.commit()
+        for fh in old:
+            self._flush(fh)
+        self.cm.commit()
+
+    def flush(self, fh):
+        self._flush(fh)
+
+    def fsync(self, fh, datasync):
+        self._flush(fh)
+        self.cm.sync()
+        self._chain_commit(fh)
+
     def release(self, fh):
+        self._flush(fh)
         self.inode_open_count[fh] -= 1
 
         if self.inode_open_count[fh] == 0:
             del self.inode_open_count[fh]
             if self.getattr(fh).st_nlink == 0:
+                self.chain_dirty.discard(fh)
                 self.cm._release(fh)
+            else:
+                self._chain_commit(fh)
+
+    def _chain_commit(self, inode):
+        if inode in self.chain_dirty:
+            self.chain_dirty.discard(inode)
+            self.chain_committer.enqueue(inode)
+
+    def destroy(self):
+        if self.chain_committer is not None:
+            self.chain_committer.stop()
+        for fh in list(self.write_buffers):
+            self._flush(fh)
+        self.cm.close()
 
 def init_logging(debug=False):
     formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(threadName)s: '
@@ -257,6 +343,17 @@ def init_logging(debug=False):
         root_logger.setLevel(logging.INFO)
     root_logger.addHandler(handler)
 
+def commit_loop(operations, interval):
+    '''Write out old buffers and commit batches that are due while the file
+    system is idle
+    '''
+
+    while True:
+        sleep(interval)
+        with llfuse.lock:
+            operations._flush_old()
+            operations.cm.commit_if_due()
+
 def parse_args():
     '''Parse command line'''
 
@@ -266,6 +363,43 @@ def parse_args():
                         help='Where to mount the file system')
     parser.add_argument('--debug', action='store_true', default=False,
                         help='Enable debugging output')
+    parser.add_argument('--db', type=str, default=':memory:',
+                        help='Database file to keep the file system in '
+                        '(default: in memory, lost on unmount)')
+    parser.add_argument('--journal-mode', type=str, default='wal',
+                        help='sqlite journal mode (default: %(default)s)')
+    parser.add_argument('--synchronous', type=str, default='normal',
+                        help='sqlite synchronous level (default: %(default)s)')
+    parser.add_argument('--page-size', type=int, default=4096,
+                        help='sqlite page size in bytes, only used when the '
+                        'database is created (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=-64 * 1024,
+                        help='sqlite cache size, in pages if positive or in KiB '
+                        'if negative (default: %(default)s)')
+    parser.add_argument('--mmap-size', type=int, default=0,
+                        help='Bytes of the database to memory map (default: %(default)s)')
+    parser.add_argument('--multithreaded', action='store_true', default=False,
+                        help='Serve requests from several worker threads, each with '
+                        'its own database connection')
+    parser.add_argument('--chain', action='store_true', default=False,
+                        help='Mount the messages stored on chain, read-only')
+    parser.add_argument('--commit-ops', type=int, default=1000,
+                        help='Commit after this many operations (default: %(default)s). '
+                        'A crash loses at most the last uncommitted batch. '
+                        'Always 1 with --multithreaded')
+    parser.add_argument('--commit-interval', type=int, default=200,
+                        help='Commit batches that are older than this many '
+                        'milliseconds (default: %(default)s)')
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='Collect call counts and latencies of all requests and SQL '
+                        'statements, readable from the .coinfs-stats file in the root '
+                        'of the mount and logged on SIGUSR1')
+    parser.add_argument('--chain-commit', action='store_true', default=False,
+                        help='Store files on chain in the background once they are '
+                        'closed or fsync\'ed')
+    parser.add_argument('--chain-queue-size', type=int, default=64,
+                        help='Files that can wait to be stored on chain before '
+                        'closing more blocks (default: %(default)s)')
 
     return parser.parse_args()
 
@@ -274,14 +408,57 @@ if __name__ == '__main__':
 
     options = parse_args()
     init_logging(options.debug)
-    operations = Operations()
+
+    # Uncommitted batches are private to a connection, other worker
+    # threads would not see them
+    if options.multithreaded and options.commit_ops > 1:
+        log.info('Group commit is not available with --multithreaded')
+        options.commit_ops = 1
+
+    commit_interval = options.commit_interval / 1000
+    db_options = {}
+    if options.stats:
+        import instrument
+        stats = instrument.Stats()
+        db_options['cursor_factory'] = instrument.cursor_factory(stats)
+
+    if options.chain:
+        from chainfs import ChainOperations as operations_class
+    else:
+        operations_class = Operations
+    operations = operations_class(options.db, journal_mode=options.journal_mode,
+                                  synchronous=options.synchronous,
+                                  page_size=options.page_size,
+                                  cache_size=options.cache_size,
+                                  mmap_size=options.mmap_size,
+                                  commit_ops=options.commit_ops,
+                                  commit_interval=commit_interval,
+                                  **db_options)
+    if options.stats:
+        instrument.instrument(operations, stats)
+        instrument.log_on_signal(stats)
+
+    if options.chain_commit and not options.chain:
+        if options.db == ':memory:':
+            log.warning('Without --db the chain journal is lost on unmount, files '
+                        'not on chain by then are not stored')
+        from chaincommit import ChainCommitter
+        operations.chain_committer = ChainCommitter(operations.cm,
+                                                    options.chain_queue_size)
+        operations.chain_committer.start()
+
+    # Also needed without group commit, for handles that write once and
+    # then stay open
+    committer = threading.Thread(target=commit_loop, name='committer',
+                                 args=(operations, commit_interval or 1))
+    committer.daemon = True
+    committer.start()
 
     llfuse.init(operations, options.mountpoint,
                 [  'fsname=tmpfs', "nonempty" ])
 
-    # sqlite3 does not support multithreading
     try:
-        llfuse.main(single=True)
+        llfuse.main(single=not options.multithreaded)
     except:
         llfuse.close(unmount=False)
         raise
@@ -0,0 +1,296 @@
+'''Call counts, latencies and cache statistics of a mounted file system
+
+Nothing here runs unless the file system is mounted with --stats. Then
+every FUSE request and every SQL statement is timed, and the statistics
+can be read from the CONTROL_NAME file in the root of the mount or are
+logged on SIGUSR1.
+'''
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import stat
+import errno
+import signal
+import sqlite3
+import logging
+import threading
+from time import time, perf_counter
+from functools import wraps
+
+import llfuse
+from llfuse import FUSEError
+
+log = logging.getLogger()
+
+# Name of the statistics file in the root directory. It is not listed by
+# readdir.
+CONTROL_NAME = b'.coinfs-stats'
+# Inodes are sqlite rowids, which are never allocated this high
+CONTROL_INODE = 2**63 - 1
+
+
+class Counter(object):
+    '''Calls of one operation or statement, with a latency histogram
+
+    hist[i] counts the calls that took less than 2**i microseconds (and at
+    least 2**(i-1)).
+    '''
+
+    __slots__ = ('calls', 'errors', 'seconds', 'hist')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0
+        self.hist = []
+
+    def add(self, seconds, failed):
+        self.calls += 1
+        self.errors += failed
+        self.seconds += seconds
+        bucket = int(seconds * 1e6).bit_length()
+        if bucket >= len(self.hist):
+            self.hist.extend([0] * (bucket + 1 - len(self.hist)))
+        self.hist[bucket] += 1
+
+    def percentile(self, fraction):
+        '''Return the histogram bucket bound below which *fraction* of the
+        calls took, in microseconds
+        '''
+
+        seen = 0
+        for bucket, n in enumerate(self.hist):
+            seen += n
+            if seen >= fraction * self.calls:
+                return 2**bucket
+        return None
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'seconds': self.seconds,
+                'mean_us': self.seconds * 1e6 / self.calls if self.calls else None,
+                'p50_us': self.percentile(0.5),
+                'p99_us': self.percentile(0.99),
+                'hist_us': dict((2**bucket, n) for bucket, n in enumerate(self.hist) if n)}
+
+
+class Stats(object):
+    '''Statistics of the file system operations and SQL statements'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.caches = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.since = time()
+            self.operations = {}
+            self.statements = {}
+            self.bytes_read = 0
+            self.bytes_written = 0
+
+    def record(self, table, key, seconds, failed=False):
+        with self.lock:
+            counter = table.get(key)
+            if counter is None:
+                counter = table[key] = Counter()
+            counter.add(seconds, failed)
+
+    def report(self):
+        '''Return the statistics as a JSON document'''
+
+        with self.lock:
+            doc = {'seconds': time() - self.since,
+                   'bytes_read': self.bytes_read,
+                   'bytes_written': self.bytes_written,
+                   'operations': dict((name, c.as_dict())
+                                      for name, c in self.operations.items()),
+                   'sql': dict((' '.join(sql.split()), c.as_dict())
+                               for sql, c in self.statements.items())}
+        doc['caches'] = {}
+        for name, cache in self.caches.items():
+            lookups = cache.hits + cache.misses
+            doc['caches'][name] = {'entries': len(cache), 'hits': cache.hits,
+                                   'misses': cache.misses,
+                                   'hit_rate': cache.hits / lookups if lookups else None}
+        return json.dumps(doc, indent=2, sort_keys=True) + '\n'
+
+
+def cursor_factory(stats):
+    '''Return a cursor class that times its statements into *stats*
+
+    Only execute() is timed, rows fetched afterwards are not.
+    '''
+
+    class InstrumentedCursor(sqlite3.Cursor):
+        def execute(self, sql, parameters=()):
+            start = perf_counter()
+            failed = True
+            try:
+                cursor = super(InstrumentedCursor, self).execute(sql, parameters)
+                failed = False
+                return cursor
+            finally:
+                stats.record(stats.statements, sql, perf_counter() - start, failed)
+
+    return InstrumentedCursor
+
+
+def _timed(stats, name, method):
+    @wraps(method)
+    def wrapper(*args):
+        # Operations calling each other are accounted to the outermost one
+        if getattr(stats.local, 'busy', False):
+            return method(*args)
+        stats.local.busy = True
+        start = perf_counter()
+        failed = True
+        try:
+            result = method(*args)
+            failed = False
+            return result
+        finally:
+            stats.local.busy = False
+            stats.record(stats.operations, name, perf_counter() - start, failed)
+
+    return wrapper
+
+
+def _timed_generator(stats, name, method):
+    # readdir returns a generator, the work happens while it is consumed
+    @wraps(method)
+    def wrapper(*args):
+        start = perf_counter()
+        failed = True
+        try:
+            for item in method(*args):
+                yield item
+            failed = False
+        finally:
+            stats.record(stats.operations, name, perf_counter() - start, failed)
+
+    return wrapper
+
+
+class ControlFile(object):
+    '''The read-only statistics file in the root of the mount
+
+    The report is rendered on getattr, so that its size is known to the
+    kernel before the file is read, and served from that copy.
+    '''
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.data = b''
+        self.uid = os.getuid()
+        self.gid = os.getgid()
+
+    def getattr(self):
+        self.data = self.stats.report().encode('utf-8')
+        now_ns = int(time() * 1e9)
+        entry = llfuse.EntryAttributes()
+        entry.st_ino = CONTROL_INODE
+        entry.generation = 0
+        # Never cached, the size changes all the time
+        entry.entry_timeout = 0
+        entry.attr_timeout = 0
+        entry.st_mode = stat.S_IFREG | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+        entry.st_nlink = 1
+        entry.st_uid = self.uid
+        entry.st_gid = self.gid
+        entry.st_rdev = 0
+        entry.st_size = len(self.data)
+        entry.st_blksize = 512
+        entry.st_blocks = (len(self.data) + 511) // 512
+        entry.st_atime_ns = now_ns
+        entry.st_mtime_ns = now_ns
+        entry.st_ctime_ns = now_ns
+        return entry
+
+    def read(self, offset, length):
+        return self.data[offset:offset + length]
+
+
+def instrument(operations, stats):
+    '''Time every request *operations* serves into *stats*
+
+    The file system's database has to be opened with a cursor_factory() of
+    the same *stats* for the SQL statements to be counted too.
+    '''
+
+    stats.caches['attr'] = operations.cm.attr_cache
+    stats.caches['dentry'] = operations.cm.dentry_cache
+
+    # Every public method is a request handler
+    for name in dir(operations):
+        method = getattr(operations, name)
+        if name.startswith('_') or not callable(method) or not hasattr(method, '__self__'):
+            continue
+        if name == 'readdir':
+            setattr(operations, name, _timed_generator(stats, name, method))
+        else:
+            setattr(operations, name, _timed(stats, name, method))
+
+    control = ControlFile(stats)
+    lookup = operations.lookup
+    getattr_ = operations.getattr
+    open_ = operations.open
+    read = operations.read
+    write = operations.write
+    release = operations.release
+
+    def lookup_control(inode_p, name):
+        if inode_p == llfuse.ROOT_INODE and name == CONTROL_NAME:
+            return control.getattr()
+        return lookup(inode_p, name)
+
+    def getattr_control(inode):
+        if inode == CONTROL_INODE:
+            return control.getattr()
+        return getattr_(inode)
+
+    def open_control(inode, flags):
+        if inode == CONTROL_INODE:
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                raise FUSEError(errno.EACCES)
+            return inode
+        return open_(inode, flags)
+
+    def read_counted(fh, offset, length):
+        if fh == CONTROL_INODE:
+            return control.read(offset, length)
+        data = read(fh, offset, length)
+        with stats.lock:
+            stats.bytes_read += len(data)
+        return data
+
+    def write_counted(fh, offset, buf):
+        written = write(fh, offset, buf)
+        with stats.lock:
+            stats.bytes_written += written
+        return written
+
+    def release_control(fh):
+        if fh != CONTROL_INODE:
+            release(fh)
+
+    operations.lookup = lookup_control
+    operations.getattr = getattr_control
+    operations.open = open_control
+    operations.read = read_counted
+    operations.write = write_counted
+    operations.release = release_control
+
+
+def log_on_signal(stats, signum=signal.SIGUSR1):
+    '''Log the statistics whenever the process receives *signum*'''
+
+    def handler(signum, frame):
+        log.info('File system statistics:\n%s', stats.report())
+
+    signal.signal(signum, handler)
@@ -0,0 +1,43 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''Bounded mapping that drops the least recently used entry when full'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                # Re-insert to mark as most recently used
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            return self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
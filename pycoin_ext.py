@@ -1,6 +1,16 @@
+import os
+import json
+import base64
+import hashlib
+
 from pycoin.encoding import wif_to_secret_exponent
 from pycoin.tx.pay_to import build_hash160_lookup
 
+try:
+    from cryptography.fernet import Fernet
+except ImportError:
+    Fernet = None
+
 class LazySecretExponentDB(object):
     def __init__(self, wif_iterable, secret_exponent_db_cache, allowable_wif_prefixes):
         self.wif_iterable = iter(wif_iterable)
@@ -18,3 +28,56 @@ class LazySecretExponentDB(object):
                 return self.secret_exponent_db_cache[v]
         self.wif_iterable = []
         return None
+
+
+class SecretExponentDB(object):
+    '''Pre-built hash160 lookup of every key of a wallet
+
+    All keys are decoded and indexed once, when added, so the same
+    instance can sign any number of transactions. The keys can be saved
+    to disk encrypted with a password (needs the cryptography package) so
+    a new session does not have to dump them from the node again.
+    '''
+
+    def __init__(self):
+        self.secret_exponents = {}
+        self.lookup = {}
+
+    def add_wifs(self, addr_wifs, allowable_wif_prefixes):
+        '''Add (address, wif) pairs'''
+
+        new = dict((addr, wif_to_secret_exponent(wif, allowable_wif_prefixes))
+                   for addr, wif in addr_wifs)
+        self.secret_exponents.update(new)
+        self.lookup.update(build_hash160_lookup(new.values()))
+
+    def has(self, addr):
+        return addr in self.secret_exponents
+
+    def get(self, v):
+        return self.lookup.get(v)
+
+    def save(self, path, password):
+        salt = os.urandom(16)
+        plain = json.dumps(dict((addr, '%x' % se) for addr, se
+                                in self.secret_exponents.items()))
+        token = _fernet(password, salt).encrypt(plain.encode('utf-8'))
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(salt + token)
+
+    def load(self, path, password):
+        with open(path, 'rb') as fh:
+            blob = fh.read()
+        plain = _fernet(password, blob[:16]).decrypt(blob[16:])
+        keys = dict((addr, int(se, 16)) for addr, se
+                    in json.loads(plain.decode('utf-8')).items())
+        self.secret_exponents.update(keys)
+        self.lookup.update(build_hash160_lookup(keys.values()))
+
+
+def _fernet(password, salt):
+    if Fernet is None:
+        raise ImportError('saving keys needs the cryptography package')
+    key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 200000)
+    return Fernet(base64.urlsafe_b64encode(key))
@@ -0,0 +1,79 @@
+import json
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class RPCClient(object):
+    '''JSON-RPC client for the coin node
+
+    Keeps HTTP connections alive in a pooled session. Independent calls are
+    sent as JSON-RPC batches, and large batches are split and sent
+    concurrently. Like the node, a call that fails returns None.
+    '''
+
+    def __init__(self, uri, timeout=30, retries=3, batch_size=100, workers=4):
+        self.uri = uri
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.ids = itertools.count()
+        self.ids_lock = threading.Lock()
+
+        # Only retry when no request went out, calls such as
+        # sendrawtransaction must not be repeated blindly
+        retry = Retry(total=retries, connect=retries, read=0, status=0,
+                      backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _next_id(self):
+        with self.ids_lock:
+            return next(self.ids)
+
+    def _post(self, payload):
+        r = self.session.post(self.uri, data=json.dumps(payload),
+                              timeout=self.timeout)
+        return r.json()
+
+    def call(self, method, params=[]):
+        rq = {'method': method, 'params': params, 'id': self._next_id()}
+        return self._post(rq)['result']
+
+    def _batch(self, calls):
+        rqs = [{'method': method, 'params': params, 'id': self._next_id()}
+               for method, params in calls]
+        # Replies may come back in any order
+        replies = dict((reply['id'], reply['result']) for reply in self._post(rqs))
+        return [replies.get(rq['id']) for rq in rqs]
+
+    def batch(self, calls, concurrent=True):
+        '''Run a list of (method, params) calls, return their results in order
+
+        With *concurrent* false, the calls reach the node strictly in order,
+        as needed for transactions that spend each other.
+        '''
+
+        calls = list(calls)
+        if len(calls) <= self.batch_size:
+            return self._batch(calls) if calls else []
+
+        chunks = [calls[i:i + self.batch_size]
+                  for i in range(0, len(calls), self.batch_size)]
+        results = []
+        mapper = self.executor.map if concurrent else map
+        for chunk_results in mapper(self._batch, chunks):
+            results.extend(chunk_results)
+        return results
+
+    def map(self, method, params_list, concurrent=True):
+        '''Call *method* once per entry of *params_list*'''
+
+        return self.batch(((method, params) for params in params_list), concurrent)
@@ -6,14 +6,62 @@ import stat
 from time import time
 from llfuse import FUSEError
 import sys
+import threading
+import hashlib
+from contextlib import contextmanager
+from lrucache import LRUCache
 
 # For Python 2 + 3 compatibility
 if sys.version_info[0] == 2:
+    from urllib import pathname2url
     def next(it):
         return it.next()
 else:
+    from urllib.request import pathname2url
     buffer = memoryview
 
+# File data is stored in fixed-size blocks so that reads, writes and
+# truncations only touch the blocks they cover. Blocks with the same
+# content share one chunk, keyed by its SHA-256. Blocks of zeros are not
+# stored at all, the missing rows are the holes of a sparse file.
+BLOCK_SIZE = 64 * 1024
+
+# Directory entries fetched per query by readdir
+READDIR_PAGE_SIZE = 256
+
+# Compiled statements kept per connection. Queries are fixed strings so
+# they are only prepared once.
+STATEMENT_CACHE_SIZE = 256
+
+# Inode columns that make up its attributes, in the order rows returned
+# by get_attr() and get_contents_page() hold them
+ATTR_COLUMNS = ('id', 'mode', 'nlink', 'uid', 'gid', 'rdev', 'size',
+                'atime_ns', 'mtime_ns', 'ctime_ns', 'allocated')
+
+SELECT_ATTR = 'SELECT %s FROM inodes WHERE id=?' % ', '.join(ATTR_COLUMNS)
+SELECT_TARGET = 'SELECT target FROM inodes WHERE id=?'
+SELECT_SIZE = 'SELECT size FROM inodes WHERE id=?'
+# Directories have a single entry, so this is unique except for the
+# root, whose '..' points at itself
+SELECT_PARENT = 'SELECT parent_inode FROM contents WHERE inode=? LIMIT 1'
+SELECT_CHILD = 'SELECT inode FROM contents WHERE name=? AND parent_inode=?'
+SELECT_CONTENTS_PAGE = ('SELECT contents.rowid, contents.name, %s '
+                        'FROM contents JOIN inodes ON inodes.id = contents.inode '
+                        'WHERE contents.parent_inode=? AND contents.rowid > ? '
+                        'ORDER BY contents.rowid LIMIT ?'
+                        % ', '.join('inodes.' + c for c in ATTR_COLUMNS))
+
+# EntryAttributes fields that setattr can change and the inodes column
+# each one is stored in
+SETATTR_COLUMNS = (('st_size', 'size'),
+                   ('st_mode', 'mode'),
+                   ('st_uid', 'uid'),
+                   ('st_gid', 'gid'),
+                   ('st_rdev', 'rdev'),
+                   ('st_atime_ns', 'atime_ns'),
+                   ('st_mtime_ns', 'mtime_ns'),
+                   ('st_ctime_ns', 'ctime_ns'))
+
 class NoUniqueValueError(Exception):
     def __str__(self):
         return 'Query generated more than 1 result row'
@@ -23,19 +71,198 @@ class NoSuchRowError(Exception):
     def __str__(self):
         return 'Query produced 0 result rows'
 
+class ConnectionState(object):
+    '''A connection together with its transaction bookkeeping'''
+
+    def __init__(self, db, cursor_factory=None):
+        self.db = db
+        self.cursor = db.cursor(cursor_factory) if cursor_factory else db.cursor()
+        # COMMIT gets its own cursor, so that committing from another
+        # thread never resets a query of the owning thread
+        self.commit_cursor = db.cursor(cursor_factory) if cursor_factory else db.cursor()
+        # Held by the owning thread while it uses the connection without
+        # the global lock (see SQLfs_Manager._read)
+        self.lock = threading.Lock()
+        self.txn_depth = 0
+        # Operations in the open group commit, and when it was started
+        self.batch_ops = 0
+        self.batch_start = None
+
+
 class SQLfs_Manager:
-    def __init__(self):
-        self.db = sqlite3.connect(':memory:')
-        self.db.text_factory = str
-        self.db.row_factory = sqlite3.Row
-        self.cursor = self.db.cursor()
+    '''Keeps the file system in sqlite
+
+    Changes made through transaction() are group committed: the sqlite
+    transaction is only committed once it holds *commit_ops* operations or
+    is *commit_interval* seconds old (see commit_if_due). Each operation is
+    atomic on its own, so after a crash the file system is consistent and
+    has lost at most the operations of the last uncommitted batch. sync()
+    commits at once. Batches are per connection, so group commit must only
+    be used with a single thread writing.
+    '''
+
+    def __init__(self, db_path=':memory:', journal_mode='wal', synchronous='normal',
+                 page_size=4096, cache_size=-64 * 1024, mmap_size=0,
+                 attr_cache_size=10000, dentry_cache_size=10000,
+                 commit_ops=1, commit_interval=0, cursor_factory=None):
+        # inode -> EntryAttributes, filled by Operations.getattr
+        self.attr_cache = LRUCache(attr_cache_size)
+        # (parent inode, name) -> inode
+        self.dentry_cache = LRUCache(dentry_cache_size)
+
+        self.db_path = db_path
+        self.journal_mode = journal_mode
+        if db_path == ':memory:':
+            # Every worker thread gets its own connection, so the in-memory
+            # database has to live in a shared cache to be visible to all
+            self.db_uri = 'file:coinfs-%x?mode=memory&cache=shared' % id(self)
+        else:
+            self.db_uri = 'file:%s' % pathname2url(os.path.abspath(db_path))
+        self.pragmas = ['PRAGMA page_size=%d' % page_size,
+                        'PRAGMA journal_mode=%s' % journal_mode,
+                        'PRAGMA synchronous=%s' % synchronous,
+                        'PRAGMA cache_size=%d' % cache_size,
+                        'PRAGMA mmap_size=%d' % mmap_size]
+        self.commit_ops = commit_ops
+        self.commit_interval = commit_interval
+        # sqlite3.Cursor subclass for all statements, see instrument.py
+        self.cursor_factory = cursor_factory
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
         self.init_tables()
 
+    def connect(self):
+        '''Open and tune a connection for the calling thread'''
+
+        # Statements outside of transaction() commit on their own
+        db = sqlite3.connect(self.db_uri, uri=True, isolation_level=None,
+                             check_same_thread=False, timeout=60,
+                             cached_statements=STATEMENT_CACHE_SIZE)
+        db.text_factory = str
+
+        # page_size only has an effect before the database is created or
+        # switched to WAL, so it has to come first
+        for pragma in self.pragmas:
+            db.execute(pragma)
+        if self.db_path == ':memory:':
+            # Shared-cache readers would otherwise take table locks that
+            # make the writer fail with SQLITE_LOCKED
+            db.execute('PRAGMA read_uncommitted=1')
+
+        return db
+
+    def _thread_state(self):
+        try:
+            return self.local.state
+        except AttributeError:
+            state = self.local.state = ConnectionState(self.connect(), self.cursor_factory)
+            with self.connections_lock:
+                self.connections.append(state)
+            return state
+
+    @property
+    def db(self):
+        return self._thread_state().db
+
+    @property
+    def cursor(self):
+        return self._thread_state().cursor
+
+    @contextmanager
+    def transaction(self):
+        '''Run the enclosed statements atomically
+
+        Nested uses join the outermost transaction.
+        '''
+
+        state = self._thread_state()
+        if state.txn_depth:
+            state.txn_depth += 1
+            try:
+                yield
+            finally:
+                state.txn_depth -= 1
+            return
+
+        if state.batch_start is None:
+            state.cursor.execute('BEGIN IMMEDIATE')
+            state.batch_start = time()
+        # A savepoint lets a failed operation roll back without taking the
+        # rest of the batch with it
+        state.cursor.execute('SAVEPOINT op')
+        state.txn_depth = 1
+        try:
+            yield
+        except:
+            state.cursor.execute('ROLLBACK TO op')
+            raise
+        else:
+            state.batch_ops += 1
+        finally:
+            state.txn_depth = 0
+            state.cursor.execute('RELEASE op')
+            self._commit_if_due(state)
+
+    def _commit_if_due(self, state, force=False):
+        if state.batch_start is None:
+            return
+        if (force or state.batch_ops == 0 or state.batch_ops >= self.commit_ops
+            or time() - state.batch_start >= self.commit_interval):
+            state.commit_cursor.execute('COMMIT')
+            state.batch_ops = 0
+            state.batch_start = None
+
+    def commit_if_due(self):
+        '''Commit batches that have grown too old
+
+        Called periodically so that idle file systems do not keep
+        changes uncommitted.
+        '''
+
+        with self.connections_lock:
+            for state in self.connections:
+                # Batches of threads that are reading just wait for the
+                # next round
+                if state.txn_depth or not state.lock.acquire(False):
+                    continue
+                try:
+                    self._commit_if_due(state)
+                finally:
+                    state.lock.release()
+
+    def commit(self):
+        '''Commit all open batches'''
+
+        with self.connections_lock:
+            for state in self.connections:
+                if not state.txn_depth:
+                    with state.lock:
+                        self._commit_if_due(state, force=True)
+
+    def sync(self):
+        '''Make everything committed so far durable'''
+
+        self.commit()
+
+        # In WAL mode with synchronous=normal commits only reach the disk at
+        # the next checkpoint
+        if self.journal_mode.lower() == 'wal' and self.db_path != ':memory:':
+            self.cursor.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self):
+        self.commit()
+        with self.connections_lock:
+            for state in self.connections:
+                state.db.close()
+            del self.connections[:]
+        self.local = threading.local()
+
     def init_tables(self):
-        '''Initialize file system tables'''
+        '''Initialize file system tables, keeping an existing schema'''
 
         self.cursor.execute("""
-        CREATE TABLE inodes (
+        CREATE TABLE IF NOT EXISTS inodes (
             id        INTEGER PRIMARY KEY,
             uid       INT NOT NULL,
             gid       INT NOT NULL,
@@ -46,151 +273,357 @@ class SQLfs_Manager:
             target    BLOB(256) ,
             size      INT NOT NULL DEFAULT 0,
             rdev      INT NOT NULL DEFAULT 0,
-            data      BLOB
+            nlink     INT NOT NULL DEFAULT 0,
+            allocated INT NOT NULL DEFAULT 0
         )
         """)
 
         self.cursor.execute("""
-        CREATE TABLE contents (
+        CREATE TABLE IF NOT EXISTS chunks (
+            hash      BLOB PRIMARY KEY,
+            refcount  INT NOT NULL DEFAULT 0,
+            data      BLOB NOT NULL
+        )""")
+
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS blocks (
+            inode     INT NOT NULL REFERENCES inodes(id),
+            block_no  INT NOT NULL,
+            hash      BLOB NOT NULL REFERENCES chunks(hash),
+
+            PRIMARY KEY (inode, block_no)
+        )""")
+
+        # Chunk reference counts follow the blocks table, a chunk goes away
+        # with the last block using it
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS chunks_ref AFTER INSERT ON blocks BEGIN
+            UPDATE chunks SET refcount=refcount+1 WHERE hash=NEW.hash;
+        END""")
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS chunks_unref AFTER DELETE ON blocks BEGIN
+            UPDATE chunks SET refcount=refcount-1 WHERE hash=OLD.hash;
+            DELETE FROM chunks WHERE hash=OLD.hash AND refcount<=0;
+        END""")
+        # Number of blocks stored for each inode, for st_blocks
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS inodes_alloc AFTER INSERT ON blocks BEGIN
+            UPDATE inodes SET allocated=allocated+1 WHERE id=NEW.inode;
+        END""")
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS inodes_free AFTER DELETE ON blocks BEGIN
+            UPDATE inodes SET allocated=allocated-1 WHERE id=OLD.inode;
+        END""")
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS chunks_reref AFTER UPDATE OF hash ON blocks
+        WHEN NEW.hash != OLD.hash BEGIN
+            UPDATE chunks SET refcount=refcount+1 WHERE hash=NEW.hash;
+            UPDATE chunks SET refcount=refcount-1 WHERE hash=OLD.hash;
+            DELETE FROM chunks WHERE hash=OLD.hash AND refcount<=0;
+        END""")
+
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS contents (
             rowid     INTEGER PRIMARY KEY AUTOINCREMENT,
             name      BLOB(256) NOT NULL,
             inode     INT NOT NULL REFERENCES inodes(id),
             parent_inode INT NOT NULL REFERENCES inodes(id),
 
-            UNIQUE (name, parent_inode)
+            UNIQUE (parent_inode, name)
+        )""")
+
+        # Reverse lookup for lookup('..')
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS contents_inode ON contents (inode)")
+
+        # Running totals for statfs, kept up to date by triggers so that
+        # every code path that creates, resizes or deletes an inode counts
+        self.cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fs_stats (
+            id        INTEGER PRIMARY KEY CHECK (id = 0),
+            size      INT NOT NULL,
+            inodes    INT NOT NULL,
+            allocated INT NOT NULL
         )""")
+        self.cursor.execute("INSERT OR IGNORE INTO fs_stats (id, size, inodes, allocated) "
+                            "SELECT 0, COALESCE(SUM(size), 0), COUNT(id), "
+                            "(SELECT COUNT(*) FROM blocks) FROM inodes")
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS fs_stats_insert AFTER INSERT ON inodes BEGIN
+            UPDATE fs_stats SET size=size+NEW.size, inodes=inodes+1;
+        END""")
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS fs_stats_delete AFTER DELETE ON inodes BEGIN
+            UPDATE fs_stats SET size=size-OLD.size, inodes=inodes-1;
+        END""")
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS fs_stats_resize AFTER UPDATE OF size ON inodes
+        WHEN NEW.size != OLD.size BEGIN
+            UPDATE fs_stats SET size=size+NEW.size-OLD.size;
+        END""")
+        # Blocks stored, holes take no space
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS fs_stats_alloc AFTER INSERT ON blocks BEGIN
+            UPDATE fs_stats SET allocated=allocated+1;
+        END""")
+        self.cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS fs_stats_free AFTER DELETE ON blocks BEGIN
+            UPDATE fs_stats SET allocated=allocated-1;
+        END""")
 
         # Insert root directory
         now_ns = int(time() * 1e9)
-        self.cursor.execute("INSERT INTO inodes (id,mode,uid,gid,mtime_ns,atime_ns,ctime_ns) "
-                            "VALUES (?,?,?,?,?,?,?)",
+        self.cursor.execute("INSERT OR IGNORE INTO inodes "
+                            "(id,mode,uid,gid,mtime_ns,atime_ns,ctime_ns,nlink) "
+                            "VALUES (?,?,?,?,?,?,?,1)",
                             (llfuse.ROOT_INODE, stat.S_IFDIR | stat.S_IRUSR | stat.S_IWUSR
                               | stat.S_IXUSR | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH
                               | stat.S_IXOTH, os.getuid(), os.getgid(), now_ns, now_ns, now_ns))
-        self.cursor.execute("INSERT INTO contents (name, parent_inode, inode) VALUES (?,?,?)",
-                            (b'..', llfuse.ROOT_INODE, llfuse.ROOT_INODE))
+        self.cursor.execute("INSERT OR IGNORE INTO contents (name, parent_inode, inode) "
+                            "VALUES (?,?,?)", (b'..', llfuse.ROOT_INODE, llfuse.ROOT_INODE))
+
+        # Files that were unlinked while still open when the previous mount
+        # went away
+        self.cursor.execute("DELETE FROM blocks WHERE inode IN "
+                            "(SELECT id FROM inodes WHERE nlink=0)")
+        self.cursor.execute("DELETE FROM inodes WHERE nlink=0")
 
 
+    def free_space(self):
+        '''Return the number of bytes the database can still grow by'''
+
+        if self.db_path == ':memory:':
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        st = os.statvfs(os.path.dirname(os.path.abspath(self.db_path)))
+        return st.f_bavail * st.f_frsize
+
     def get_row(self, *a, **kw):
-        self.cursor.execute(*a, **kw)
-        try:
-            row = next(self.cursor)
-        except StopIteration:
-            raise NoSuchRowError()
-        try:
-            next(self.cursor)
-        except StopIteration:
-            pass
-        else:
-            raise NoUniqueValueError()
+        '''Return the row of a query that has at most one, as a tuple
+
+        Callers only query by unique keys, so no check is made for a
+        second row.
+        '''
 
+        row = self.cursor.execute(*a, **kw).fetchone()
+        if row is None:
+            raise NoSuchRowError()
         return row
 
+    def get_attr(self, inode):
+        '''Return the ATTR_COLUMNS of *inode*'''
+
+        return self.get_row(SELECT_ATTR, (inode,))
+
+    def get_target(self, inode):
+        return self.get_row(SELECT_TARGET, (inode,))[0]
+
     def lookup(self, inode_p, name):
-        if name == '.':
+        if name == b'.':
             inode = inode_p
-        elif name == '..':
-            inode = self.get_row("SELECT * FROM contents WHERE inode=?",
-                                 (inode_p,))['parent_inode']
+        elif name == b'..':
+            inode = self.get_row(SELECT_PARENT, (inode_p,))[0]
         else:
+            inode = self.dentry_cache.get((inode_p, name))
+            if inode is not None:
+                return inode
             try:
-                inode = self.get_row("SELECT * FROM contents WHERE name=? AND parent_inode=?",
-                                     (name, inode_p))['inode']
+                inode = self.get_row(SELECT_CHILD, (name, inode_p))[0]
             except NoSuchRowError:
                 raise(llfuse.FUSEError(errno.ENOENT))
+            self.dentry_cache.put((inode_p, name), inode)
         return inode
 
-    def get_contents_list(self, inode, off):
-        cursor = self.db.cursor()
-        cursor.execute("SELECT * FROM contents WHERE parent_inode=? "
-                        'AND rowid > ? ORDER BY rowid', (inode, off))
-        return cursor
+    def get_contents_page(self, inode, off, limit=READDIR_PAGE_SIZE):
+        '''Return up to *limit* entries of directory *inode* after *off*
+
+        Each row holds the entry's rowid, which is its offset, its name and
+        then the ATTR_COLUMNS of the inode it points to.
+        '''
+
+        return self.cursor.execute(SELECT_CONTENTS_PAGE, (inode, off, limit)).fetchall()
 
     def delete_contents(self, name, inode_p):
-        self.cursor.execute("DELETE FROM contents WHERE name=? AND parent_inode=?",
-                        (name, inode_p))
+        with self.transaction():
+            inode = self.lookup(inode_p, name)
+            self.cursor.execute("DELETE FROM contents WHERE name=? AND parent_inode=?",
+                            (name, inode_p))
+            self.cursor.execute("UPDATE inodes SET nlink=nlink-1 WHERE id=?", (inode,))
+            self.dentry_cache.pop((inode_p, name))
+            self.attr_cache.pop(inode)
 
     def delete_inodes(self, inode):
-        self.cursor.execute("DELETE FROM inodes WHERE id=?", (inode,))
+        with self.transaction():
+            self.attr_cache.pop(inode)
+            self.cursor.execute("DELETE FROM blocks WHERE inode=?", (inode,))
+            self.cursor.execute("DELETE FROM inodes WHERE id=?", (inode,))
 
     def rename(self, name_new, inode_p_new, name_old, inode_p_old):
-        self.cursor.execute("UPDATE contents SET name=?, parent_inode=? WHERE name=? "
-                            "AND parent_inode=?", (name_new, inode_p_new,
-                                                   name_old, inode_p_old))
+        with self.transaction():
+            self.cursor.execute("UPDATE contents SET name=?, parent_inode=? WHERE name=? "
+                                "AND parent_inode=?", (name_new, inode_p_new,
+                                                       name_old, inode_p_old))
+            self.dentry_cache.pop((inode_p_old, name_old))
+            self.dentry_cache.pop((inode_p_new, name_new))
 
     def replace(self, inode_p_old, name_old, inode_p_new, name_new,
                  entry_old, entry_new):
-
-        if self.get_row("SELECT COUNT(inode) FROM contents WHERE parent_inode=?",
-                        (entry_new.st_ino,))[0] > 0:
-            raise llfuse.FUSEError(errno.ENOTEMPTY)
-
-        self.cursor.execute("UPDATE contents SET inode=? WHERE name=? AND parent_inode=?",
-                            (entry_old.st_ino, name_new, inode_p_new))
-        self.db.execute('DELETE FROM contents WHERE name=? AND parent_inode=?',
-                        (name_old, inode_p_old))
-
-        if entry_new.st_nlink == 1 and entry_new.st_ino not in self.inode_open_count:
-            self.cursor.execute("DELETE FROM inodes WHERE id=?", (entry_new.st_ino,))
+        with self.transaction():
+            if self.get_row("SELECT COUNT(inode) FROM contents WHERE parent_inode=?",
+                            (entry_new.st_ino,))[0] > 0:
+                raise llfuse.FUSEError(errno.ENOTEMPTY)
+
+            self.cursor.execute("UPDATE contents SET inode=? WHERE name=? AND parent_inode=?",
+                                (entry_old.st_ino, name_new, inode_p_new))
+            self.cursor.execute('DELETE FROM contents WHERE name=? AND parent_inode=?',
+                                (name_old, inode_p_old))
+            # entry_old keeps its link count, the entry it replaced loses one
+            self.cursor.execute("UPDATE inodes SET nlink=nlink-1 WHERE id=?",
+                                (entry_new.st_ino,))
+            self.dentry_cache.pop((inode_p_old, name_old))
+            self.dentry_cache.pop((inode_p_new, name_new))
+            self.attr_cache.pop(entry_new.st_ino)
 
     def _link(self, new_name, inode, new_inode_p):
-        self.cursor.execute("INSERT INTO contents (name, inode, parent_inode) VALUES(?,?,?)",
-                            (new_name, inode, new_inode_p))
+        with self.transaction():
+            self.cursor.execute("INSERT INTO contents (name, inode, parent_inode) VALUES(?,?,?)",
+                                (new_name, inode, new_inode_p))
+            self.cursor.execute("UPDATE inodes SET nlink=nlink+1 WHERE id=?", (inode,))
+            self.attr_cache.pop(inode)
 
     def _setattr(self, inode, attr):
-        if attr.st_size is not None:
-            data = self.get_row('SELECT data FROM inodes WHERE id=?', (inode,))[0]
-            if data is None:
-                data = b''
-            if len(data) < attr.st_size:
-                data = data + b'\0' * (attr.st_size - len(data))
-            else:
-                data = data[:attr.st_size]
-            self.cursor.execute('UPDATE inodes SET data=?, size=? WHERE id=?',
-                                (buffer(data), attr.st_size, inode))
-        if attr.st_mode is not None:
-            self.cursor.execute('UPDATE inodes SET mode=? WHERE id=?',
-                                (attr.st_mode, inode))
-
-        if attr.st_uid is not None:
-            self.cursor.execute('UPDATE inodes SET uid=? WHERE id=?',
-                                (attr.st_uid, inode))
-
-        if attr.st_gid is not None:
-            self.cursor.execute('UPDATE inodes SET gid=? WHERE id=?',
-                                (attr.st_gid, inode))
-
-        if attr.st_rdev is not None:
-            self.cursor.execute('UPDATE inodes SET rdev=? WHERE id=?',
-                                (attr.st_rdev, inode))
-
-        if attr.st_atime_ns is not None:
-            self.cursor.execute('UPDATE inodes SET atime_ns=? WHERE id=?',
-                                (attr.st_atime_ns, inode))
-
-        if attr.st_mtime_ns is not None:
-            self.cursor.execute('UPDATE inodes SET mtime_ns=? WHERE id=?',
-                                (attr.st_mtime_ns, inode))
-
-        if attr.st_ctime_ns is not None:
-            self.cursor.execute('UPDATE inodes SET ctime_ns=? WHERE id=?',
-                                (attr.st_ctime_ns, inode))
+        columns = []
+        values = []
+        for field, column in SETATTR_COLUMNS:
+            value = getattr(attr, field)
+            if value is not None:
+                columns.append(column + '=?')
+                values.append(value)
+        if not columns:
+            return
+
+        with self.transaction():
+            if attr.st_size is not None:
+                self._truncate(inode, attr.st_size)
+            self.cursor.execute('UPDATE inodes SET %s WHERE id=?' % ', '.join(columns),
+                                values + [inode])
+            self.attr_cache.pop(inode)
 
     def _create(self, inode_p, name, ctx, mode, rdev=0, target=None):
-        now_ns = int(time() * 1e9)
-        self.cursor.execute('INSERT INTO inodes (uid, gid, mode, mtime_ns, atime_ns, '
-                            'ctime_ns, target, rdev) VALUES(?, ?, ?, ?, ?, ?, ?, ?)',
-                            (ctx.uid, ctx.gid, mode, now_ns, now_ns, now_ns, target, rdev))
-
-        inode = self.cursor.lastrowid
-        self.db.execute("INSERT INTO contents(name, inode, parent_inode) VALUES(?,?,?)",
-                        (name, inode, inode_p))
-        return inode
-
-    def _write(self, inode, data):
-        self.cursor.execute('UPDATE inodes SET data=?, size=? WHERE id=?',
-                            (buffer(data), len(data), inode))
+        with self.transaction():
+            now_ns = int(time() * 1e9)
+            self.cursor.execute('INSERT INTO inodes (uid, gid, mode, mtime_ns, atime_ns, '
+                                'ctime_ns, target, rdev, nlink) VALUES(?, ?, ?, ?, ?, ?, ?, ?, 1)',
+                                (ctx.uid, ctx.gid, mode, now_ns, now_ns, now_ns, target, rdev))
+
+            inode = self.cursor.lastrowid
+            self.cursor.execute("INSERT INTO contents(name, inode, parent_inode) VALUES(?,?,?)",
+                                (name, inode, inode_p))
+            return inode
+
+    def _get_block(self, inode, block_no):
+        return self.get_row('SELECT data FROM blocks JOIN chunks ON chunks.hash = blocks.hash '
+                            'WHERE inode=? AND block_no=?', (inode, block_no))[0]
+
+    def _put_block(self, inode, block_no, data):
+        '''Point block *block_no* of *inode* at the chunk holding *data*
+
+        The data is only stored if no other block has the same content.
+        A block of zeros becomes a hole instead.
+        '''
+
+        if data.count(b'\0') == len(data):
+            self.cursor.execute('DELETE FROM blocks WHERE inode=? AND block_no=?',
+                                (inode, block_no))
+            return
+
+        digest = hashlib.sha256(data).digest()
+        self.cursor.execute('INSERT OR IGNORE INTO chunks (hash, data) VALUES (?,?)',
+                            (digest, buffer(data)))
+        # An upsert rather than INSERT OR REPLACE, whose implicit delete
+        # would not fire the chunks_unref trigger
+        self.cursor.execute('INSERT INTO blocks (inode, block_no, hash) VALUES (?,?,?) '
+                            'ON CONFLICT (inode, block_no) DO UPDATE SET hash=excluded.hash',
+                            (inode, block_no, digest))
+
+    def _read(self, inode, offset, length):
+        '''Return file data, may be called without the global lock'''
+
+        state = self._thread_state()
+        with state.lock:
+            return self._read_locked(state.cursor, inode, offset, length)
+
+    def _read_locked(self, cursor, inode, offset, length):
+        row = cursor.execute(SELECT_SIZE, (inode,)).fetchone()
+        if row is None:
+            raise NoSuchRowError()
+        length = min(length, row[0] - offset)
+        if length <= 0:
+            return b''
+
+        # Only the requested slice of each covered block is copied out of
+        # sqlite. Blocks that were never written (or lie past a short last
+        # block) read back as zeros.
+        buf = bytearray(length)
+        end = offset + length
+        cursor.execute('SELECT block_no, MAX(? - block_no * ?, 0), '
+                       'substr(data, MAX(? - block_no * ?, 0) + 1, '
+                       'MIN(? - block_no * ?, ?) - MAX(? - block_no * ?, 0)) '
+                       'FROM blocks JOIN chunks ON chunks.hash = blocks.hash '
+                       'WHERE inode=? AND block_no BETWEEN ? AND ?',
+                       (offset, BLOCK_SIZE, offset, BLOCK_SIZE, end, BLOCK_SIZE,
+                        BLOCK_SIZE, offset, BLOCK_SIZE, inode,
+                        offset // BLOCK_SIZE, (end - 1) // BLOCK_SIZE))
+        for block_no, lo, data in cursor:
+            pos = block_no * BLOCK_SIZE + lo - offset
+            buf[pos:pos + len(data)] = data
+        return bytes(buf)
+
+    def _write(self, inode, offset, buf):
+        with self.transaction():
+            end = offset + len(buf)
+            for block_no in range(offset // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1):
+                start = block_no * BLOCK_SIZE
+                lo = max(offset, start)
+                hi = min(end, start + BLOCK_SIZE)
+                chunk = buf[lo - offset:hi - offset]
+
+                if hi - lo < BLOCK_SIZE:
+                    # Partial block, merge with what is already stored
+                    try:
+                        old = self._get_block(inode, block_no)
+                    except NoSuchRowError:
+                        old = b''
+                    if len(old) < lo - start:
+                        old = old + b'\0' * (lo - start - len(old))
+                    chunk = old[:lo - start] + chunk + old[hi - start:]
+
+                self._put_block(inode, block_no, chunk)
+
+            self.cursor.execute('UPDATE inodes SET size=MAX(size, ?) WHERE id=?',
+                                (end, inode))
+            self.attr_cache.pop(inode)
+
+    def _truncate(self, inode, size):
+        '''Drop the stored data past *size*
+
+        The caller updates the inode size. Growing a file leaves a hole
+        that reads back as zeros, so nothing is stored for it.
+        '''
+
+        with self.transaction():
+            self.cursor.execute('DELETE FROM blocks WHERE inode=? AND block_no>=?',
+                                (inode, (size + BLOCK_SIZE - 1) // BLOCK_SIZE))
+            if size % BLOCK_SIZE:
+                # The shortened last block has different content, so it
+                # needs a chunk of its own
+                try:
+                    old = self._get_block(inode, size // BLOCK_SIZE)
+                except NoSuchRowError:
+                    return
+                if len(old) > size % BLOCK_SIZE:
+                    self._put_block(inode, size // BLOCK_SIZE, old[:size % BLOCK_SIZE])
 
     def _release(self, fh):
-        self.cursor.execute("DELETE FROM inodes WHERE id=?", (fh,))
-
+        with self.transaction():
+            self.attr_cache.pop(fh)
+            self.cursor.execute("DELETE FROM blocks WHERE inode=?", (fh,))
+            self.cursor.execute("DELETE FROM inodes WHERE id=?", (fh,))
@@ -0,0 +1,206 @@
+'''Tests for storing payloads as chains of OP_RETURN transactions
+
+They run commit_transaction against a fake node, in process, and are
+skipped without pycoin. A config module is provided if there is none, so
+the user's configuration is not needed.
+'''
+
+import sys
+import types
+import random
+from binascii import hexlify
+
+import pytest
+
+pytest.importorskip('pycoin')
+if 'config' not in sys.modules:
+    sys.modules['config'] = types.ModuleType('config')
+    sys.modules['config'].config = {}
+
+from pycoin.tx import Tx
+from pycoin.key import Key
+from pycoin.encoding import a2b_hashed_base58
+from pycoin.tx.script import tools
+
+import commit_transaction as ct
+from coinselect import fee_for_size, tx_size
+from pycoin_ext import SecretExponentDB
+from txcache import TxCache
+
+FEE_PER_KB = 10**5
+
+
+class FakeNode(object):
+    '''Just enough of the node's JSON-RPC interface to build and send
+    chains, like bench.FakeNode without the HTTP server
+    '''
+
+    def __init__(self, address, wif, script, n_utxos):
+        self.address = address
+        self.wif = wif
+        self.sent = []
+        self.txs = {}
+        self.blocks = {}
+        self.mempool = set()
+        self.utxos = []
+        for i in range(n_utxos):
+            self.utxos.append({'txid': '%064x' % (i + 1), 'vout': 0,
+                               'amount': random.Random(i).randint(1, 10**4) / 10**4,
+                               'scriptPubKey': script, 'address': address})
+
+    def call(self, method, params):
+        if method == 'getrawtransaction':
+            return self.txs.get(params[0])
+        if method == 'getblock':
+            return self.blocks.get(params[0])
+        if method == 'getmempoolentry':
+            return {'time': 1} if params[0] in self.mempool else None
+        if method == 'listunspent':
+            return self.utxos
+        if method == 'estimatesmartfee':
+            return {'feerate': FEE_PER_KB / ct.COIN}
+        if method == 'dumpprivkey':
+            return self.wif if params[0] == self.address else None
+        if method == 'sendrawtransaction':
+            self.sent.append(params[0])
+            return '%064x' % len(self.sent)
+        return None
+
+    def map(self, method, params, concurrent=True):
+        return [self.call(method, p) for p in params]
+
+
+@pytest.fixture
+def node(monkeypatch):
+    key = Key(secret_exponent=0xbe4c4)
+    wif = key.wif()
+    script = hexlify(tools.compile('OP_DUP OP_HASH160 %s OP_EQUALVERIFY OP_CHECKSIG'
+                                   % hexlify(key.hash160()).decode('ascii'))).decode('ascii')
+    node = FakeNode(key.address(), wif, script, 20)
+    key_db = SecretExponentDB()
+    key_db.add_wifs([(key.address(), wif)], [a2b_hashed_base58(wif)[:1]])
+    monkeypatch.setattr(ct, 'rpc_client', node)
+    monkeypatch.setattr(ct, 'key_db', key_db)
+    return node
+
+
+def payload(tx):
+    return ct.extract_msg({'hex': hexlify(tx.txs_out[-1].script).decode('ascii')})
+
+
+@pytest.mark.parametrize('msg', [b'\x00', b'\x07', b'\x10', b'\x22', b'\x12\x34', b'\xff' * 80])
+def test_msg_round_trip(msg):
+    script = ct.format_msg(hexlify(msg).decode('ascii')).script
+    assert ct.extract_msg({'hex': hexlify(script).decode('ascii')}) == msg
+
+
+def test_chunk_data():
+    assert ct.chunk_data(b'') == []
+    assert ct.chunk_data(b'x' * ct.MAX_MSG) == [b'x' * ct.MAX_MSG]
+    chunks = ct.chunk_data(bytes(range(200)))
+    assert [len(c) for c in chunks] == [80, 80, 40]
+    assert b''.join(chunks) == bytes(range(200))
+
+
+@pytest.mark.parametrize('size', [1, 80, 81, 200, 2000])
+def test_chain_stores_every_chunk(node, size):
+    data = bytes(random.Random(size).getrandbits(8) for _ in range(size))
+    head = ct.create_spend(node.utxos[0])
+    txs = ct.create_chained_txs(head, [node.address], data)
+
+    assert len(txs) == (size + ct.MAX_MSG - 1) // ct.MAX_MSG
+    assert b''.join(payload(tx) for tx in txs) == data
+    for tx in txs:
+        assert tx.txs_out[-1].coin_value == ct.MSG_VALUE
+        assert all(tx.is_signature_ok(i) for i in range(len(tx.txs_in)))
+
+
+def test_chain_spends_previous_change(node):
+    head = ct.create_spend(node.utxos[0])
+    txs = ct.create_chained_txs(head, [node.address], b'x' * 400)
+
+    first = [(txin.previous_hash, txin.previous_index) for txin in txs[0].txs_in]
+    assert (head.tx_hash, head.tx_out_index) in first
+    for prev, tx in zip(txs, txs[1:]):
+        assert len(tx.txs_in) == 1
+        assert tx.txs_in[0].previous_hash == prev.hash()
+        assert tx.txs_in[0].previous_index == 0
+
+
+def test_chain_fees_and_change(node):
+    head = ct.create_spend(node.utxos[0])
+    chunks = ct.chunk_data(b'y' * 250)
+    txs = ct.create_chained_txs(head, [node.address], b'y' * 250)
+
+    assert txs[0].fee() >= fee_for_size(tx_size(len(txs[0].txs_in), 1, len(chunks[0])),
+                                        FEE_PER_KB)
+    for prev, tx, chunk in zip(txs, txs[1:], chunks[1:]):
+        fee = fee_for_size(tx_size(1, 1, len(chunk)), FEE_PER_KB)
+        assert tx.fee() == fee
+        assert tx.txs_out[0].coin_value == prev.txs_out[0].coin_value - ct.MSG_VALUE - fee
+    # The last change output can carry the next chain
+    assert txs[-1].txs_out[0].coin_value >= ct.MIN_CHANGE
+
+
+def test_put_data_sends_parents_first(node):
+    head = ct.create_spend(node.utxos[0])
+    pool = [ct.create_spend(utxo) for utxo in node.utxos]
+    txids = ct.put_data(head, [node.address], b'z' * 300, pool)
+
+    assert len(txids) == len(node.sent) == 4
+    assert [payload(Tx.from_hex(raw)) for raw in node.sent] == ct.chunk_data(b'z' * 300)
+
+
+def test_search_last_ranks_by_block(node, monkeypatch):
+    # a and b are in the same block, b after a. c is older but its cached
+    # copy claims fewer confirmations than the others.
+    script = node.utxos[0]['scriptPubKey']
+    for txid, blockhash in (('a', 'B2'), ('b', 'B2'), ('c', 'B1')):
+        node.txs[txid * 64] = {
+            'txid': txid * 64, 'blockhash': blockhash * 32, 'confirmations': 5,
+            'vin': [{'coinbase': '00'}],
+            'vout': [{'value': 1.0, 'n': 0, 'scriptPubKey': {'hex': script}},
+                     {'value': 0.01, 'n': 1, 'scriptPubKey': {'hex': '6a01' + txid * 2}}]}
+    node.txs['c' * 64]['confirmations'] = 1
+    node.blocks = {'B1' * 32: {'height': 7, 'confirmations': 2, 'tx': ['c' * 64]},
+                   'B2' * 32: {'height': 8, 'confirmations': 1, 'tx': ['a' * 64, 'b' * 64]}}
+    monkeypatch.setattr(ct, 'tx_cache', TxCache(':memory:'))
+    sps = [ct.create_spend_from_tx(node.txs[txid * 64], 0) for txid in 'cba']
+
+    sp, script = ct.search_last_tx_data(sps)
+    assert ct.sp_txid(sp) == 'b' * 64
+
+    # Unconfirmed transactions are newer than any block
+    node.txs['c' * 64].pop('blockhash')
+    node.mempool.add('c' * 64)
+    monkeypatch.setattr(ct, 'tx_cache', TxCache(':memory:'))
+    sp, script = ct.search_last_tx_data(sps)
+    assert ct.sp_txid(sp) == 'c' * 64
+
+
+def test_search_last_refetches_reorganised(node, monkeypatch):
+    script = node.utxos[0]['scriptPubKey']
+    for txid, blockhash in (('a', 'B2'), ('c', 'B1')):
+        node.txs[txid * 64] = {
+            'txid': txid * 64, 'blockhash': blockhash * 32, 'confirmations': 5,
+            'vin': [{'coinbase': '00'}],
+            'vout': [{'value': 1.0, 'n': 0, 'scriptPubKey': {'hex': script}},
+                     {'value': 0.01, 'n': 1, 'scriptPubKey': {'hex': '6a01' + txid * 2}}]}
+    node.blocks = {'B1' * 32: {'height': 7, 'confirmations': 2, 'tx': ['c' * 64]},
+                   'B2' * 32: {'height': 8, 'confirmations': 1, 'tx': ['a' * 64]}}
+    monkeypatch.setattr(ct, 'tx_cache', TxCache(':memory:'))
+    sps = [ct.create_spend_from_tx(node.txs[txid * 64], 0) for txid in 'ca']
+    assert ct.sp_txid(ct.search_last_tx_data(sps)[0]) == 'a' * 64
+
+    # B1 is reorganised away and c mined again in B3, the cached copy
+    # still names B1
+    node.blocks['B1' * 32]['confirmations'] = -1
+    node.blocks['B3' * 32] = {'height': 9, 'confirmations': 1, 'tx': ['c' * 64]}
+    node.txs['c' * 64] = dict(node.txs['c' * 64], blockhash='B3' * 32)
+    assert ct.sp_txid(ct.search_last_tx_data(sps)[0]) == 'c' * 64
+
+    # Then B3 goes too and c is dropped, it is never the newest
+    node.blocks['B3' * 32]['confirmations'] = -1
+    node.txs['c' * 64] = dict(node.txs['c' * 64], confirmations=0)
+    del node.txs['c' * 64]['blockhash']
+    assert ct.sp_txid(ct.search_last_tx_data(sps)[0]) == 'a' * 64
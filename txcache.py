@@ -0,0 +1,52 @@
+import sqlite3
+import json
+import threading
+
+
+class TxCache(object):
+    '''Persistent cache of decoded transactions, keyed by txid
+
+    Only confirmed transactions are stored, since they never change, and
+    without their number of confirmations, which does. Can be shared
+    between threads.
+    '''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("""
+        CREATE TABLE IF NOT EXISTS transactions (
+            txid      TEXT PRIMARY KEY,
+            tx        TEXT NOT NULL
+        )""")
+
+    def get_many(self, txids):
+        '''Return a txid -> transaction dict of the cached *txids*'''
+
+        found = {}
+        with self.lock:
+            for txid in txids:
+                row = self.db.execute('SELECT tx FROM transactions WHERE txid=?',
+                                      (txid,)).fetchone()
+                if row is not None:
+                    found[txid] = json.loads(row[0])
+        return found
+
+    def put_many(self, txs):
+        # The number of confirmations is stale as soon as it is stored
+        rows = [(tx['txid'], json.dumps(dict((k, v) for k, v in tx.items()
+                                             if k != 'confirmations')))
+                for tx in txs if tx is not None and tx.get('confirmations', 0) > 0]
+        if rows:
+            with self.lock:
+                self.db.execute('BEGIN')
+                self.db.executemany('INSERT OR IGNORE INTO transactions (txid, tx) '
+                                    'VALUES (?,?)', rows)
+                self.db.execute('COMMIT')
+
+    def discard(self, txids):
+        '''Forget *txids*, for transactions whose block was reorganised away'''
+
+        with self.lock:
+            self.db.executemany('DELETE FROM transactions WHERE txid=?',
+                                [(txid,) for txid in txids])
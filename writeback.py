@@ -0,0 +1,54 @@
+from time import time
+
+# A handle's dirty data is written out once it holds this many bytes or its
+# oldest write is this many seconds old
+MAX_DIRTY_BYTES = 4 * 1024 * 1024
+MAX_DIRTY_AGE = 5
+
+
+class WriteBuffer(object):
+    '''Dirty data of an open file handle
+
+    Writes are kept as sorted, non-overlapping extents. A write that overlaps
+    or touches an existing extent is merged into it, so sequential writes
+    build up a single extent.
+    '''
+
+    def __init__(self):
+        self.extents = []
+        self.size = 0
+        self.since = None
+
+    def add(self, offset, buf):
+        if self.since is None:
+            self.since = time()
+
+        end = offset + len(buf)
+        base_off, base = offset, None
+        tail = b''
+        extents = []
+        for ext_off, ext in self.extents:
+            ext_end = ext_off + len(ext)
+            if ext_end < offset or ext_off > end:
+                extents.append((ext_off, ext))
+                continue
+            self.size -= len(ext)
+            if ext_off <= offset:
+                base_off, base = ext_off, ext
+            if ext_end > end:
+                tail = ext[end - ext_off:]
+
+        # Newer data wins where it overlaps older extents
+        if base is None:
+            base = bytearray()
+        base[offset - base_off:] = buf
+        base += tail
+
+        extents.append((base_off, base))
+        extents.sort(key=lambda ext: ext[0])
+        self.extents = extents
+        self.size += len(base)
+
+    def is_full(self):
+        return (self.size >= MAX_DIRTY_BYTES
+                or time() - self.since >= MAX_DIRTY_AGE)